@@ -0,0 +1,397 @@
+import asyncio
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Coroutine, Optional, Tuple
+from peer_connection import FileBlock, PeerConnection
+
+class AsyncPeerEngine:
+    """Runs every AsyncPeerConnection on a single asyncio event loop thread."""
+    
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+    
+    def start(self):
+        if self.loop is not None:
+            return
+        
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        if self.loop is None:
+            return
+        
+        loop, thread = self.loop, self._thread
+        self.loop = None
+        self._thread = None
+        loop.call_soon_threadsafe(loop.stop)
+        
+        # stop() may be reached from a callback running on the loop itself
+        if threading.current_thread() is not thread:
+            thread.join(timeout=5)
+    
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        loop = self.loop
+        try:
+            loop.run_forever()
+        finally:
+            # Let cancelled tasks unwind before the loop goes away
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+    
+    def in_loop_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+    
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def call_soon(self, callback: Callable, *args):
+        if self.loop is None:
+            return
+        if self.in_loop_thread():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+class CountingStreamReader(asyncio.StreamReader):
+    """StreamReader that counts the chunks the transport feeds it, one per recv."""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recv_calls = 0
+    
+    def feed_data(self, data: bytes):
+        self.recv_calls += 1
+        super().feed_data(data)
+
+def counting_protocol(client_connected_cb: Optional[Callable] = None) -> asyncio.StreamReaderProtocol:
+    # Must be called on the loop
+    return asyncio.StreamReaderProtocol(CountingStreamReader(), client_connected_cb)
+
+async def open_connection(host: str, port: int) -> Tuple[CountingStreamReader, asyncio.StreamWriter]:
+    # asyncio.open_connection with a CountingStreamReader
+    loop = asyncio.get_running_loop()
+    reader = CountingStreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await loop.create_connection(lambda: protocol, host, port)
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+class AsyncPeerConnection(PeerConnection):
+    """PeerConnection driven by asyncio streams instead of a dedicated thread.
+    
+    Message handling is inherited; only the transport and upload scheduling differ.
+    """
+    
+    def __init__(self, engine: AsyncPeerEngine, peer_ip: str, peer_port: int,
+                 info_hash: bytes, peer_id: bytes, piece_manager, scheduler,
+                 min_requests: int = 2, max_requests: int = 256, connect_timeout: float = 10):
+        super().__init__(peer_ip, peer_port, info_hash, peer_id, piece_manager, scheduler,
+                         min_requests, max_requests, connect_timeout)
+        self.engine = engine
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.uploads_scheduled = False
+        self.upload_loading = False  # A block is being read off the loop; the queue waits for it
+        self.flush_scheduled = False
+        self.outbox_waiting = False  # A task holds the file block at the outbox head until it can go out
+    
+    def connect(self) -> bool:
+        # Blocking variant kept for API parity with PeerConnection
+        return self.engine.submit(self.connect_async()).result()
+    
+    async def connect_async(self) -> bool:
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                open_connection(self.peer_ip, self.peer_port), timeout=self.connect_timeout
+            )
+            self.connected = True
+            print(f"[+] TCP Connected to {self.peer_ip}:{self.peer_port}")
+            
+            # Send handshake
+            self._send(self._build_handshake())
+            print(f"[>] Sent Handshake to {self.peer_ip}:{self.peer_port}")
+            
+            # Receive and verify handshake response
+            response = await asyncio.wait_for(self.reader.readexactly(68), timeout=self.connect_timeout)
+            if not self._valid_handshake(response):
+                self.disconnect()
+                return False
+            
+            print(f"[<] Received Handshake OK from {self.peer_ip}:{self.peer_port}")
+            self._start_session()
+            
+            return True
+        
+        except Exception as e:
+            print(f"Connection error to {self.peer_ip}:{self.peer_port}: {e}")
+            self.disconnect()
+            return False
+    
+    async def accept_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        # Inbound counterpart of connect_async for streams from the listener
+        try:
+            self.reader, self.writer = reader, writer
+            self.connected = True
+            self.inbound = True
+            
+            response = await asyncio.wait_for(self.reader.readexactly(68), timeout=self.connect_timeout)
+            if not self._valid_handshake(response):
+                self.disconnect()
+                return False
+            
+            self._send(self._build_handshake())
+            print(f"[<] Accepted Handshake from {self.peer_ip}:{self.peer_port}")
+            self._start_session()
+            
+            return True
+        
+        except Exception as e:
+            print(f"Inbound connection error from {self.peer_ip}:{self.peer_port}: {e}")
+            self.disconnect()
+            return False
+    
+    def disconnect(self):
+        # Connection state belongs to the loop; the connection manager's threads hand over
+        # rather than release claims while the loop may be handling a block
+        if self.engine.loop is not None and not self.engine.in_loop_thread():
+            self.engine.call_soon(self.disconnect)
+            return
+        
+        super().disconnect()
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+        if writer:
+            self.engine.call_soon(writer.close)
+    
+    def _start_message_loop(self):
+        self.engine.loop.create_task(self._message_loop_async())
+    
+    async def _message_loop_async(self):
+        # No per-read wait_for: it wraps every read in a task and yields to the loop even
+        # when data is buffered. A periodic tick enforces timeouts instead.
+        self.last_received = time.time()
+        self.engine.loop.call_later(self.TICK_INTERVAL, self._on_tick)
+        
+        # disconnect() clears self.reader; closing the transport ends reads on this one
+        reader = self.reader
+        while self.running and self.connected:
+            try:
+                # Read message length
+                length_data = await reader.readexactly(4)
+                length = struct.unpack('>I', length_data)[0]
+                self.last_received = time.time()
+                
+                if length == 0:
+                    # Keep-alive message
+                    continue
+                
+                # Read message
+                message_data = await reader.readexactly(length)
+                
+                self._handle_message(memoryview(message_data))
+            
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except Exception as e:
+                print(f"Message loop error: {e}")
+                break
+        
+        self.disconnect()
+    
+    def _on_tick(self):
+        if not self.running or self.engine.loop is None:
+            return
+        
+        self._tick()
+        if self.running:
+            self.engine.loop.call_later(self.TICK_INTERVAL, self._on_tick)
+    
+    def _handle_request(self, payload: bytes):
+        super()._handle_request(payload)
+        
+        # readexactly only yields to the loop once buffered data runs out, so this
+        # runs after the current batch of messages and any cancels in it
+        if self.upload_queue and not self.uploads_scheduled:
+            self.uploads_scheduled = True
+            self.engine.loop.call_soon(self._serve_uploads_soon)
+    
+    def _serve_uploads_soon(self):
+        self.uploads_scheduled = False
+        self._serve_uploads()
+        
+        if self.upload_loading or self.outbox_waiting:
+            return  # The task loading a block or waiting on the outbox goes on with the queue
+        if self.upload_queue and self.connected and not self.peer_choked:
+            # Stopped at the high-water mark: go on once the transport has drained
+            self.uploads_scheduled = True
+            self.engine.loop.create_task(self._serve_uploads_after_drain())
+    
+    async def _serve_uploads_after_drain(self):
+        try:
+            await self.writer.drain()
+        except Exception:
+            self.uploads_scheduled = False
+            return
+        self._serve_uploads_soon()
+    
+    def _can_upload(self) -> bool:
+        return not self.upload_loading and super()._can_upload()
+    
+    def _send_piece(self, piece_index: int, offset: int, length: int) -> int:
+        if (self.piece_manager.zero_copy or self.piece_manager.is_piece_cached(piece_index)
+                or not self.piece_manager.is_block_available(piece_index, offset, length)):
+            return super()._send_piece(piece_index, offset, length)
+        
+        # A read-cache miss reads the whole piece, which on the loop would stall every peer
+        self.upload_loading = True
+        self.engine.loop.create_task(self._send_piece_after_load(piece_index, offset, length))
+        return 0
+    
+    async def _send_piece_after_load(self, piece_index: int, offset: int, length: int):
+        # Reads the block through the read cache on a worker thread, sends it, and goes on
+        # with the rest of the queue
+        try:
+            block_data = await self.engine.loop.run_in_executor(
+                None, self.piece_manager.get_block, piece_index, offset, length, (self.peer_ip, self.peer_port))
+            if block_data and self.connected and not self.peer_choked:
+                self._send(struct.pack('>IBII', 9 + length, 7, piece_index, offset), block_data)
+                self.uploaded += length
+        except Exception as e:
+            print(f"Upload error to {self.peer_ip}:{self.peer_port}: {e}")
+            self.disconnect()
+        finally:
+            self.upload_loading = False
+        
+        if self.connected:
+            self._serve_uploads_soon()
+    
+    def _start_session(self):
+        # drain() waits from HIGH_WATER buffered bytes rather than asyncio's 64 KiB default
+        self.writer.transport.set_write_buffer_limits(high=self.HIGH_WATER)
+        super()._start_session()
+    
+    def _send_piece_zero_copy(self, header: bytes, piece_index: int, offset: int, length: int):
+        # Runs on the loop. The block is queued as a file range behind the header and goes
+        # out with sendfile once the transport has nothing buffered ahead of it.
+        if self.writer is None:
+            raise ConnectionError("Not connected")
+        
+        self._queue((header, FileBlock(piece_index, offset, length)))
+        self._flush_outbox()
+    
+    def _send(self, *buffers):
+        if self.writer is None:
+            raise ConnectionError("Not connected")
+        self.engine.call_soon(self._enqueue, buffers)
+    
+    def _enqueue(self, buffers):
+        # Runs on the loop; everything queued before the loop gets back to its callbacks
+        # goes out in one write
+        self._queue(buffers)
+        if not self.flush_scheduled and self.engine.loop is not None:
+            self.flush_scheduled = True
+            self.engine.loop.call_soon(self._flush_outbox)
+    
+    def _flush_outbox(self):
+        self.flush_scheduled = False
+        writer = self.writer
+        if writer is None:
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            return
+        if self.outbox_waiting:
+            return
+        
+        while self.outbox:
+            head = self.outbox[0]
+            if type(head) is not FileBlock:
+                # Buffers up to the next file block: a gathering sendmsg on Python 3.12+,
+                # one joined write before that
+                buffers = []
+                while self.outbox and type(self.outbox[0]) is not FileBlock:
+                    buffers.append(self.outbox.popleft())
+                self.outbox_bytes -= sum(len(buffer) for buffer in buffers)
+                writer.writelines(buffers)
+                self.send_calls += 1
+                continue
+            
+            if writer.transport.get_write_buffer_size():
+                # The transport still holds data that must reach the socket first
+                self.outbox_waiting = True
+                self.engine.loop.create_task(self._flush_after_drain(writer))
+                return
+            
+            try:
+                sent = self.piece_manager.send_block(writer.get_extra_info('socket').fileno(),
+                                                     head.piece_index, head.offset, head.length)
+            except OSError as e:
+                print(f"Upload error to {self.peer_ip}:{self.peer_port}: {e}")
+                self.disconnect()
+                return
+            self.send_calls += 1
+            self.outbox_bytes -= sent
+            if sent < head.length:
+                # The socket is full and only the transport waits for room in it: the rest
+                # is read off the loop and handed to the transport
+                head.offset += sent
+                head.length -= sent
+                self.outbox_waiting = True
+                self.engine.loop.create_task(self._flush_after_load(writer, head))
+                return
+            self.outbox.popleft()
+    
+    async def _flush_after_drain(self, writer: asyncio.StreamWriter):
+        # A zero high-water mark pauses the protocol until the transport's buffer is empty,
+        # not just below HIGH_WATER
+        transport = writer.transport
+        transport.set_write_buffer_limits(high=0)
+        try:
+            await writer.drain()
+        except Exception:
+            return  # The message loop sees the connection go
+        finally:
+            if not transport.is_closing():
+                transport.set_write_buffer_limits(high=self.HIGH_WATER)
+            self.outbox_waiting = False
+        self._resume_outbox(writer)
+    
+    async def _flush_after_load(self, writer: asyncio.StreamWriter, block: FileBlock):
+        try:
+            rest = await self.engine.loop.run_in_executor(
+                None, self.piece_manager.read_block, block.piece_index, block.offset, block.length)
+            if rest is None:
+                raise ConnectionError(f"Block {block.piece_index}:{block.offset} became unreadable")
+        except Exception as e:
+            self.outbox_waiting = False
+            print(f"Upload error to {self.peer_ip}:{self.peer_port}: {e}")
+            self.disconnect()
+            return
+        
+        self.outbox_waiting = False
+        if self.writer is not writer:
+            return
+        self.outbox.popleft()
+        self.outbox_bytes -= block.length
+        writer.write(rest)
+        self.send_calls += 1
+        self._resume_outbox(writer)
+    
+    def _resume_outbox(self, writer: asyncio.StreamWriter):
+        if self.writer is not writer:
+            return
+        self._flush_outbox()
+        if self.upload_queue and not self.uploads_scheduled:
+            self._serve_uploads_soon()
+    
+    def _backlog(self) -> int:
+        writer = self.writer
+        return self.outbox_bytes + (writer.transport.get_write_buffer_size() if writer else 0)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the bencode codec.
+Usage: python benchmarks/bench_bencode.py [files]
+
+Decodes and encodes a synthetic multi-file .torrent and two tracker responses,
+comparing the old recursive codec that lived in TorrentParser with bencode.py.
+The info_hash row compares re-encoding the info dict with hashing its raw span.
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bencode
+
+def _legacy_decode(data: bytes):
+    def decode_next(data: bytes, index: int = 0):
+        if data[index:index+1] == b'i':
+            end = data.find(b'e', index)
+            return int(data[index+1:end]), end + 1
+        elif data[index:index+1] == b'l':
+            result = []
+            index += 1
+            while data[index:index+1] != b'e':
+                item, index = decode_next(data, index)
+                result.append(item)
+            return result, index + 1
+        elif data[index:index+1] == b'd':
+            result = {}
+            index += 1
+            while data[index:index+1] != b'e':
+                key, index = decode_next(data, index)
+                value, index = decode_next(data, index)
+                result[key] = value
+            return result, index + 1
+        elif data[index:index+1].isdigit():
+            colon = data.find(b':', index)
+            length = int(data[index:colon])
+            return data[colon+1:colon+1+length], colon + 1 + length
+        else:
+            raise ValueError(f"Invalid bencode at index {index}")
+    
+    result, _ = decode_next(data)
+    return result
+
+def _legacy_encode(data) -> bytes:
+    if isinstance(data, int):
+        return f"i{data}e".encode()
+    elif isinstance(data, bytes):
+        return f"{len(data)}:".encode() + data
+    elif isinstance(data, list):
+        result = b'l'
+        for item in data:
+            result += _legacy_encode(item)
+        result += b'e'
+        return result
+    elif isinstance(data, dict):
+        result = b'd'
+        for key in sorted(data.keys()):
+            result += _legacy_encode(key)
+            result += _legacy_encode(data[key])
+        result += b'e'
+        return result
+    raise ValueError(f"Cannot encode type {type(data)}")
+
+def _make_torrent(num_files: int) -> bytes:
+    piece_length = 256 * 1024
+    files = [{b'length': 1000000 + i, b'path': [b'dir%d' % (i % 100), b'file%06d.bin' % i]}
+             for i in range(num_files)]
+    total = sum(f[b'length'] for f in files)
+    num_pieces = (total + piece_length - 1) // piece_length
+    return bencode.encode({
+        b'announce': b'http://tracker.example.com:6969/announce',
+        b'announce-list': [[b'http://tracker.example.com:6969/announce'], [b'udp://tracker.example.org:1337']],
+        b'info': {
+            b'name': b'benchmark',
+            b'piece length': piece_length,
+            b'pieces': os.urandom(20 * num_pieces),
+            b'files': files
+        }
+    })
+
+def _make_tracker_responses():
+    compact = bencode.encode({b'interval': 1800, b'complete': 120, b'incomplete': 80,
+                              b'peers': os.urandom(6 * 200)})
+    dict_model = bencode.encode({b'interval': 1800, b'peers': [
+        {b'ip': b'10.0.%d.%d' % (i // 256, i % 256), b'port': 6881 + i, b'peer id': os.urandom(20)}
+        for i in range(1000)]})
+    return compact, dict_model
+
+def _time(func, *args) -> float:
+    # Best of several runs, in milliseconds
+    best = float('inf')
+    repeats = 9
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def _legacy_info_hash(data: bytes) -> bytes:
+    return hashlib.sha1(_legacy_encode(_legacy_decode(data)[b'info'])).digest()
+
+def _span_info_hash(data: bytes) -> bytes:
+    _, (start, end) = bencode.decode_with_span(data, b'info')
+    return hashlib.sha1(memoryview(data)[start:end]).digest()
+
+def bench(name: str, data: bytes):
+    value = bencode.decode(data)
+    assert _legacy_decode(data) == value and _legacy_encode(value) == bencode.encode(value) == data
+    
+    legacy_decode, new_decode = _time(_legacy_decode, data), _time(bencode.decode, data)
+    legacy_encode, new_encode = _time(_legacy_encode, value), _time(bencode.encode, value)
+    print(f"{name:>18} ({len(data) / 1e6:5.2f} MB): "
+          f"decode {legacy_decode:8.2f} -> {new_decode:7.2f} ms | "
+          f"encode {legacy_encode:8.2f} -> {new_encode:7.2f} ms")
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    
+    torrent = _make_torrent(num_files)
+    compact, dict_model = _make_tracker_responses()
+    
+    bench("torrent", torrent)
+    bench("compact peers", compact)
+    bench("dict-model peers", dict_model)
+    
+    assert _legacy_info_hash(torrent) == _span_info_hash(torrent)
+    print(f"{'info_hash':>18}: re-encode {_time(_legacy_info_hash, torrent):8.2f} ms -> "
+          f"raw span {_time(_span_info_hash, torrent):7.2f} ms (both include decoding)")
+
+if __name__ == "__main__":
+    main()
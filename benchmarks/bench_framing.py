@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Loopback benchmark for the peer message receive path.
+Usage: python benchmarks/bench_framing.py [megabytes]
+
+Streams piece messages over a local socket pair and compares the old
+bytes-concatenating receive loop with MessageReader.
+"""
+
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from peer_connection import MessageReader
+
+BLOCK_SIZE = 16384
+
+def _sender(sock: socket.socket, num_blocks: int):
+    block = os.urandom(BLOCK_SIZE)
+    message = struct.pack('>IBII', 9 + BLOCK_SIZE, 7, 0, 0) + block
+    batch = message * 16
+    for _ in range(num_blocks // 16):
+        sock.sendall(batch)
+    sock.shutdown(socket.SHUT_WR)
+
+def _legacy_recv_exact(sock: socket.socket, length: int):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def _run_legacy(sock: socket.socket, sink: bytearray) -> int:
+    received = 0
+    while True:
+        length_data = _legacy_recv_exact(sock, 4)
+        if not length_data:
+            return received
+        length = struct.unpack('>I', length_data)[0]
+        message = _legacy_recv_exact(sock, length)
+        if not message:
+            return received
+        payload = message[1:]
+        block = payload[8:]
+        sink[:len(block)] = block
+        received += len(block)
+
+def _run_reader(sock: socket.socket, sink: bytearray) -> int:
+    reader = MessageReader(sock)
+    received = 0
+    while True:
+        try:
+            message = reader.read_message()
+        except ConnectionError:
+            return received
+        block = message[9:]
+        sink[:len(block)] = block
+        received += len(block)
+
+def _stream(receive, num_blocks: int) -> int:
+    left, right = socket.socketpair()
+    sink = bytearray(BLOCK_SIZE)
+    sender = threading.Thread(target=_sender, args=(left, num_blocks))
+    sender.start()
+    received = receive(right, sink)
+    sender.join()
+    left.close()
+    right.close()
+    return received
+
+def bench(name: str, receive, num_blocks: int):
+    start = time.perf_counter()
+    received = _stream(receive, num_blocks)
+    elapsed = time.perf_counter() - start
+    
+    # Second, shorter pass under tracemalloc, which slows everything down
+    tracemalloc.start()
+    _stream(receive, min(num_blocks, 1024))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    print(f"{name:>8}: {received / elapsed / 1e6:8.1f} MB/s | peak traced memory {peak / 1024:8.1f} KiB")
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    num_blocks = megabytes * 1024 * 1024 // BLOCK_SIZE
+    
+    bench("legacy", _run_legacy, num_blocks)
+    bench("reader", _run_reader, num_blocks)
+
+if __name__ == "__main__":
+    main()
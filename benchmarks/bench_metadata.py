@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Load-time benchmark for torrent metadata.
+Usage: python benchmarks/bench_metadata.py [pieces] [files]
+
+Writes a synthetic .torrent (500k pieces and 100k files by default) and loads it
+with the old representation (a list of 20-byte hashes and a dict per file) and
+with TorrentParser's PieceHashes/FileTable. Both decode with bencode.py, so the
+difference is the metadata itself. Retained memory is what the loaded metadata
+keeps alive once the decoded tree is gone.
+"""
+
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bencode
+from torrent_parser import TorrentParser
+
+def _make_torrent(path: str, num_pieces: int, num_files: int):
+    total_length = num_pieces * 16384
+    lengths = [total_length // num_files] * num_files
+    lengths[-1] += total_length - sum(lengths)
+    files = [{b'length': length, b'path': [b'dir%03d' % (i % 1000), b'file%07d.bin' % i]}
+             for i, length in enumerate(lengths)]
+    with open(path, 'wb') as f:
+        f.write(bencode.encode({
+            b'announce': b'http://tracker.example.com:6969/announce',
+            b'info': {
+                b'name': b'benchmark',
+                b'piece length': 16384,
+                b'pieces': os.urandom(20 * num_pieces),
+                b'files': files
+            }
+        }))
+
+def _legacy_load(path: str):
+    # The representation before PieceHashes/FileTable, plus PieceManager's hash list
+    with open(path, 'rb') as f:
+        torrent_data = bencode.decode(f.read())
+    info = torrent_data[b'info']
+    files = []
+    for file_info in info[b'files']:
+        files.append({
+            'path': '/'.join([part.decode('utf-8') for part in file_info[b'path']]),
+            'length': file_info[b'length']
+        })
+    pieces = info[b'pieces']
+    hashes = [pieces[i:i+20] for i in range(0, len(pieces), 20)]
+    return files, hashes
+
+def _new_load(path: str):
+    metadata = TorrentParser(path).parse()
+    return metadata['files'], metadata['piece_hashes']
+
+def _retained_memory(load, path: str):
+    gc.collect()
+    tracemalloc.start()
+    result = load(path)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained, peak
+
+def main():
+    num_pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    num_files = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    loaders = [("legacy", _legacy_load), ("compact", _new_load)]
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "huge.torrent")
+        _make_torrent(path, num_pieces, num_files)
+        print(f"{num_pieces} pieces, {num_files} files, {os.path.getsize(path) / 1e6:.1f} MB .torrent")
+        
+        # Alternate the loaders and keep each one's best time, so drift hits both alike
+        best = {name: float('inf') for name, _ in loaders}
+        for _ in range(5):
+            for name, load in loaders:
+                gc.collect()
+                start = time.perf_counter()
+                result = load(path)
+                best[name] = min(best[name], time.perf_counter() - start)
+                del result
+        
+        for name, load in loaders:
+            retained, peak = _retained_memory(load, path)
+            print(f"{name:>7}: load {best[name] * 1000:8.1f} ms | "
+                  f"retained {retained / 1e6:7.1f} MB | peak {peak / 1e6:7.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from typing import Any, List, Optional, Tuple
+
+class BencodeError(ValueError):
+    pass
+
+def decode(data: bytes) -> Any:
+    return _decode(data, None)[0]
+
+def decode_with_span(data: bytes, key: bytes) -> Tuple[Any, Optional[Tuple[int, int]]]:
+    """Decodes data and also returns the (start, end) byte span of the top-level
+    dictionary value stored under key, or None if there is no such dictionary.
+    
+    The info_hash must be taken over the info dictionary exactly as it appears in
+    the .torrent file; re-encoding the decoded value changes non-canonical input.
+    """
+    return _decode(data, key)
+
+def encode(value: Any) -> bytes:
+    parts = []
+    _encode_into(value, parts)
+    return b''.join(parts)
+
+def _decode(data: bytes, span_key: Optional[bytes]) -> Tuple[Any, Optional[Tuple[int, int]]]:
+    # Iterative, so deeply nested input cannot exhaust the Python stack. Tokens are
+    # read as integers and strings located with find(), so only values are sliced.
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    find = data.find
+    length = len(data)
+    index = 0
+    stack = []  # (container, pending key) of each enclosing list/dict
+    container = None  # Innermost open list/dict
+    key = None  # Key waiting for its value when container is a dict
+    span_start = -1
+    span = None
+    
+    while True:
+        if index >= length:
+            raise BencodeError("Unexpected end of data")
+        token = data[index]
+        
+        if 0x30 <= token <= 0x39:  # String: <length>:<bytes>
+            colon = find(b':', index)
+            # int() alone would also take whitespace, signs and underscores
+            if colon < 0 or not data[index:colon].isdigit():
+                raise BencodeError(f"Invalid string length at index {index}")
+            end = colon + 1 + int(data[index:colon])
+            if end > length:
+                raise BencodeError("Unexpected end of data")
+            value = data[colon + 1:end]
+            index = end
+        elif token == 0x69:  # Integer: i<digits>e
+            end = find(b'e', index)
+            if end < 0:
+                raise BencodeError("Unexpected end of data")
+            negative = data[index + 1] == 0x2D
+            digits = data[index + 2:end] if negative else data[index + 1:end]
+            # Canonical form only: no leading zeros, and no negative zero
+            if not digits.isdigit() or (digits[0] == 0x30 and (negative or len(digits) > 1)):
+                raise BencodeError(f"Invalid integer at index {index}")
+            value = int(data[index + 1:end])
+            index = end + 1
+        elif token == 0x6C or token == 0x64:  # Start of a list or dictionary
+            if token == 0x64 and container is not None and not stack:
+                span_start = index
+            if container is not None:
+                stack.append((container, key))
+            container = [] if token == 0x6C else {}
+            key = None
+            index += 1
+            continue
+        elif token == 0x65 and container is not None:  # End of the innermost one
+            if key is not None:
+                raise BencodeError(f"Dictionary key without a value at index {index}")
+            value = container
+            container, key = stack.pop() if stack else (None, None)
+            index += 1
+        else:
+            raise BencodeError(f"Invalid bencode at index {index}")
+        
+        # Attach the finished value to its parent; trailing data after the root is ignored
+        if container is None:
+            return value, span
+        if type(container) is list:
+            container.append(value)
+        elif key is None:
+            if type(value) is not bytes:
+                raise BencodeError(f"Dictionary key is not a string at index {index}")
+            key = value
+        else:
+            if key == span_key and not stack and type(value) is dict:
+                span = (span_start, index)
+            container[key] = value
+            key = None
+
+def _encode_into(value: Any, parts: List[bytes]):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(b'%d:' % len(value))
+        parts.append(value)
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+        parts.append(b'%d:' % len(value))
+        parts.append(value)
+    elif isinstance(value, int):
+        parts.append(b'i%de' % value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(b'l')
+        for item in value:
+            _encode_into(item, parts)
+        parts.append(b'e')
+    elif isinstance(value, dict):
+        # Keys are sorted as raw byte strings
+        items = sorted(((key.encode('utf-8') if isinstance(key, str) else key, item)
+                        for key, item in value.items()), key=lambda pair: pair[0])
+        parts.append(b'd')
+        for key, item in items:
+            _encode_into(key, parts)
+            _encode_into(item, parts)
+        parts.append(b'e')
+    else:
+        raise BencodeError(f"Cannot encode type {type(value)}")
@@ -0,0 +1,85 @@
+from typing import Iterator, Optional
+
+class Bitfield:
+    """Fixed-size set of piece indexes packed one bit per piece in wire order.
+    
+    Byte 0's high bit is piece 0, exactly as in the peer wire bitfield message,
+    so parsing and serializing are plain byte copies. The number of set bits is
+    kept up to date on every change.
+    """
+    
+    __slots__ = ('length', 'bits', 'count')
+    
+    def __init__(self, length: int, data: Optional[bytes] = None):
+        self.length = length
+        self.bits = bytearray((length + 7) // 8)
+        self.count = 0
+        
+        if data is not None:
+            size = min(len(data), len(self.bits))
+            self.bits[:size] = data[:size]
+            # Spare bits past the last piece must stay clear so whole-field operations work
+            if length % 8 and size == len(self.bits):
+                self.bits[-1] &= (0xFF << (8 - length % 8)) & 0xFF
+            self.count = self._popcount(self.bits)
+    
+    @classmethod
+    def from_bytes(cls, data: bytes, length: int) -> 'Bitfield':
+        return cls(length, data)
+    
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
+    
+    def __len__(self) -> int:
+        return self.length
+    
+    def __getitem__(self, index: int) -> bool:
+        if not 0 <= index < self.length:
+            raise IndexError("bitfield index out of range")
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+    
+    def set(self, index: int) -> bool:
+        # Returns True if the bit was newly set
+        if self[index]:
+            return False
+        self.bits[index >> 3] |= 0x80 >> (index & 7)
+        self.count += 1
+        return True
+    
+    def clear(self, index: int) -> bool:
+        # Returns True if the bit was set before
+        if not self[index]:
+            return False
+        self.bits[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+        self.count -= 1
+        return True
+    
+    def all(self) -> bool:
+        return self.count == self.length
+    
+    def any(self) -> bool:
+        return self.count > 0
+    
+    def indexes(self) -> Iterator[int]:
+        # Set bits in ascending order; empty bytes are skipped whole
+        for byte_index, byte in enumerate(self.bits):
+            if not byte:
+                continue
+            base = byte_index << 3
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield base + bit
+    
+    def difference(self, other: 'Bitfield') -> 'Bitfield':
+        # Bits set here but not in other, e.g. peer_bitfield.difference(completed_pieces)
+        # is what a peer has that we lack. Computed on whole integers, not bit by bit.
+        mine = int.from_bytes(self.bits, 'big')
+        theirs = int.from_bytes(other.bits[:len(self.bits)].ljust(len(self.bits), b'\x00'), 'big')
+        return Bitfield(self.length, (mine & ~theirs).to_bytes(len(self.bits), 'big'))
+    
+    def __repr__(self) -> str:
+        return f"Bitfield({self.count}/{self.length})"
+    
+    @staticmethod
+    def _popcount(data: bytes) -> int:
+        return bin(int.from_bytes(data, 'big')).count('1')
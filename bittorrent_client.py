@@ -3,24 +3,61 @@ import random
 import string
 import threading
 import time
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from torrent_parser import TorrentParser
 from tracker_client import TrackerClient
+from tracker_manager import TrackerManager
+from connection_manager import ConnectionManager
+from choker import Choker
+from peer_listener import PeerListener, AsyncPeerListener
 from peer_connection import PeerConnection
+from async_peer_connection import AsyncPeerConnection, AsyncPeerEngine
 from piece_manager import PieceManager
+from piece_picker import PiecePicker
+from request_scheduler import RequestScheduler
+from resume_data import ResumeData
+
+PEER_ENGINES = ("thread", "asyncio")
 
 class BitTorrentClient:    
-    def __init__(self, download_path: str = "./downloads"):
+    def __init__(self, download_path: str = "./downloads", engine: str = "thread",
+                 hash_workers: Optional[int] = None, storage: str = "file",
+                 min_requests: int = 2, max_requests: int = 256, upload_slots: int = 4):
+        if engine not in PEER_ENGINES:
+            raise ValueError(f"Unknown peer engine: {engine}")
+        
         self.download_path = download_path
         self.peer_id = self._generate_peer_id()
         self.port = 6881
+        self.port_range = range(6881, 6890)  # Listen ports to try, in order
+        self.listener = None
         
         self.torrent_metadata = None
         self.piece_manager = None
+        self.resume_data = None
+        self.piece_picker = None
+        self.scheduler = None
+        self.resume_interval = 60  # Seconds between periodic resume file saves
         self.tracker_client = None
-        self.peer_connections = {}
+        self.tracker_manager = None
+        self.max_connections = 50
+        self.connection_manager = None
+        self.dial_executor = None
+        self.choker = None
+        self.upload_slots = upload_slots  # Peers unchoked by rate, plus one optimistic slot
+        
+        # "thread" runs one OS thread per peer, "asyncio" multiplexes all peers on one event loop
+        self.engine = engine
+        self.hash_workers = hash_workers
+        self.storage = storage
+        self.min_requests = min_requests  # Bounds on each peer's adaptive request queue depth
+        self.max_requests = max_requests
+        self.peer_engine = AsyncPeerEngine() if engine == "asyncio" else None
         
         self.running = False
+        self.stop_lock = threading.Lock()
+        self.download_complete = threading.Event()  # Set on the disk writer thread; the status loop stops
         
     def _generate_peer_id(self) -> bytes:
         prefix = b"-PY0001-"
@@ -38,7 +75,21 @@ class BitTorrentClient:
             print(f"Files: {len(self.torrent_metadata['files'])}")
             
             # Initialize piece manager
-            self.piece_manager = PieceManager(self.torrent_metadata, self.download_path)
+            self.piece_manager = PieceManager(
+                self.torrent_metadata, self.download_path,
+                on_piece_received=self._on_piece_received,
+                hash_workers=self.hash_workers,
+                storage=self.storage
+            )
+            
+            # Restore completed pieces from a previous run
+            self.resume_data = ResumeData(self.piece_manager, self.torrent_metadata['info_hash'])
+            restored = self.resume_data.load()
+            if restored:
+                print(f"Resumed {restored}/{self.torrent_metadata['num_pieces']} pieces")
+            
+            # Rarest-first piece selection and block claims shared by all peers
+            self._create_scheduler()
             
             # Initialize tracker client
             self.tracker_client = TrackerClient(self.peer_id, self.port)
@@ -49,6 +100,24 @@ class BitTorrentClient:
             print(f"Error loading torrent: {e}")
             return False
     
+    def recheck(self, workers: Optional[int] = None, use_processes: bool = False) -> Dict[str, Any]:
+        # Verify existing on-disk data against the torrent's piece hashes
+        def report(pieces_done, pieces_total, bytes_done, elapsed):
+            rate = bytes_done / elapsed / 1e9 if elapsed > 0 else 0.0
+            print(f"\rRechecking: {pieces_done}/{pieces_total} pieces | {rate:.2f} GB/s", end='', flush=True)
+        
+        stats = self.piece_manager.recheck(workers=workers, use_processes=use_processes, progress=report)
+        print(f"\nRecheck complete: {stats['pieces_valid']}/{stats['pieces_checked']} pieces valid, "
+              f"{stats['bytes_checked']:,} bytes in {stats['seconds']:.2f}s ({stats['gb_per_second']:.2f} GB/s)")
+        
+        self.resume_data.save()
+        self._create_scheduler()
+        return stats
+    
+    def _create_scheduler(self):
+        self.piece_picker = PiecePicker(self.piece_manager.num_pieces, self.piece_manager.completed_pieces)
+        self.scheduler = RequestScheduler(self.piece_manager, self.piece_picker)
+    
     def start_download(self):
         if not self.torrent_metadata:
             print("No torrent loaded!")
@@ -56,8 +125,32 @@ class BitTorrentClient:
         
         self.running = True
         
-        # Start peer discovery and connection thread
-        threading.Thread(target=self._peer_discovery_loop, daemon=True).start()
+        if self.peer_engine:
+            self.peer_engine.start()
+        else:
+            # Blocking connects run here, at most MAX_PENDING at a time
+            self.dial_executor = ThreadPoolExecutor(max_workers=ConnectionManager.MAX_PENDING,
+                                                    thread_name_prefix="dial")
+        self.connection_manager = ConnectionManager(self._dial_peer, self.max_connections)
+        self.choker = Choker(self.connection_manager.get_connections,
+                             is_seeding=self.piece_manager.completed_pieces.all,
+                             upload_slots=self.upload_slots)
+        self._start_listener()
+        
+        # Announce to all tracker tiers in the background; peers go to the connection manager
+        self.tracker_manager = TrackerManager(
+            self.tracker_client,
+            self.torrent_metadata['info_hash'],
+            self.torrent_metadata['announce'],
+            self.torrent_metadata['announce_list'],
+            get_stats=self._get_transfer_stats,
+            on_peers=self.connection_manager.add_peers
+        )
+        self.tracker_manager.start()
+        self.choker.start()
+        
+        # Start peer maintenance thread
+        threading.Thread(target=self._peer_maintenance_loop, daemon=True).start()
         
         # Start status reporting thread
         threading.Thread(target=self._status_loop, daemon=True).start()
@@ -65,95 +158,94 @@ class BitTorrentClient:
         print("Download started!")
     
     def stop_download(self):
-        self.running = False
+        # Reached from the main thread and from the status loop on completion; runs once
+        with self.stop_lock:
+            if not self.running:
+                return
+            self.running = False
+        
+        if self.choker:
+            self.choker.stop()
+        
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
         
         # Disconnect all peers
-        for peer_conn in list(self.peer_connections.values()):
-            peer_conn.disconnect()
+        if self.connection_manager:
+            self.connection_manager.stop()
+        if self.dial_executor:
+            self.dial_executor.shutdown(wait=False)
+        
+        if self.peer_engine:
+            self.peer_engine.stop()
         
-        self.peer_connections.clear()
+        if self.tracker_manager:
+            self.tracker_manager.stop()
+        
+        # Let verified pieces reach the disk before their state and file sizes are saved
+        if self.piece_manager:
+            self.piece_manager.close()
+        if self.resume_data:
+            self.resume_data.save()
         print("Download stopped!")
     
-    def _peer_discovery_loop(self):
+    def _start_listener(self):
+        # Accept inbound peers on the first free port and announce that one
+        for port in self.port_range:
+            if self.peer_engine:
+                listener = AsyncPeerListener(self.peer_engine, port, self._accept_peer_async)
+            else:
+                listener = PeerListener(port, self._accept_peer)
+            try:
+                listener.start()
+            except OSError as e:
+                print(f"Cannot listen on port {port}: {e}")
+                continue
+            
+            self.listener = listener
+            self.port = listener.port
+            self.tracker_client.port = listener.port
+            print(f"Listening for peers on port {listener.port}")
+            return
+        
+        print("No listen port available, connecting to peers outbound only")
+    
+    def _peer_maintenance_loop(self):
         while self.running:
             try:
-                # Get peers from trackers
-                peers = self._get_peers_from_trackers()
+                # Rescore peers and redial candidates whose backoff has run out
+                self.connection_manager.maintain()
                 
-                # Connect to new peers
-                for peer in peers:
-                    if len(self.peer_connections) >= 50:  # Limit connections
-                        break
-                    
-                    peer_key = f"{peer['ip']}:{peer['port']}"
-                    if peer_key not in self.peer_connections:
-                        self._connect_to_peer(peer['ip'], peer['port'])
+                # Out of peers: ask the trackers again as soon as their min interval allows
+                if self.connection_manager.is_idle():
+                    self.tracker_manager.announce_now()
                 
-                # Clean up dead connections
-                self._cleanup_dead_connections()
-                
-                time.sleep(30)  # Wait before next tracker scrape
+                time.sleep(5)
                 
             except Exception as e:
-                print(f"Peer discovery error: {e}")
-                time.sleep(10)
+                print(f"Peer maintenance error: {e}")
+                time.sleep(5)
     
-    def _get_peers_from_trackers(self) -> List[Dict[str, Any]]:
-        all_peers = []
-        
-        # Try main announce URL
-        announce_url = self.torrent_metadata['announce']
-        if announce_url.startswith('http'):
-            peers = self.tracker_client.scrape_http_tracker(
-                announce_url, 
-                self.torrent_metadata['info_hash'],
-                left=self._get_bytes_left()
-            )
-            all_peers.extend(peers)
-        elif announce_url.startswith('udp'):
-            peers = self.tracker_client.scrape_udp_tracker(
-                announce_url,
-                self.torrent_metadata['info_hash'],
-                left=self._get_bytes_left()
-            )
-            all_peers.extend(peers)
-        
-        # Try announce list
-        for tier in self.torrent_metadata['announce_list']:
-            for url in tier:
-                if len(all_peers) >= 100:  # Limit peer list
-                    break
-                
-                try:
-                    if url.startswith('http'):
-                        peers = self.tracker_client.scrape_http_tracker(
-                            url,
-                            self.torrent_metadata['info_hash'],
-                            left=self._get_bytes_left()
-                        )
-                        all_peers.extend(peers)
-                    elif url.startswith('udp'):
-                        peers = self.tracker_client.scrape_udp_tracker(
-                            url,
-                            self.torrent_metadata['info_hash'],
-                            left=self._get_bytes_left()
-                        )
-                        all_peers.extend(peers)
-                except:
-                    continue
-        
-        return all_peers
+    def _get_transfer_stats(self) -> Tuple[int, int, int]:
+        # (uploaded, downloaded, left) for tracker announces
+        uploaded = self.connection_manager.uploaded() if self.connection_manager else 0
+        if not self.piece_manager:
+            return uploaded, 0, self.torrent_metadata['total_length']
+        return uploaded, self.piece_manager.completed_bytes, self._get_bytes_left()
     
     def _get_bytes_left(self) -> int:
         if not self.piece_manager:
             return self.torrent_metadata['total_length']
         
-        completed_bytes = 0
-        for i, is_complete in enumerate(self.piece_manager.completed_pieces):
-            if is_complete:
-                completed_bytes += self.piece_manager.get_piece_length(i)
-        
-        return max(0, self.torrent_metadata['total_length'] - completed_bytes)
+        return max(0, self.piece_manager.bytes_left)
+    
+    def _dial_peer(self, ip: str, port: int):
+        # Called by the connection manager; must not block
+        if self.peer_engine:
+            self._connect_to_peer_async(ip, port)
+        else:
+            self.dial_executor.submit(self._connect_to_peer, ip, port)
     
     def _connect_to_peer(self, ip: str, port: int):
         peer_key = f"{ip}:{port}"
@@ -164,60 +256,184 @@ class BitTorrentClient:
                 self.torrent_metadata['info_hash'],
                 self.peer_id,
                 self.piece_manager,
-                self._on_piece_received
+                self.scheduler,
+                min_requests=self.min_requests,
+                max_requests=self.max_requests,
+                connect_timeout=ConnectionManager.CONNECT_TIMEOUT
             )
+            peer_conn.on_interested = self.choker.peer_interested
             
             if peer_conn.connect():
-                self.peer_connections[peer_key] = peer_conn
                 print(f"Connected to peer: {peer_key}")
+                self.connection_manager.connection_made(peer_conn)
+                return
             
         except Exception as e:
             print(f"Failed to connect to {peer_key}: {e}")
+        self.connection_manager.connection_failed(ip, port)
+    
+    def _connect_to_peer_async(self, ip: str, port: int):
+        # Dial without blocking the caller; the event loop reports the result once the handshake completes
+        peer_key = f"{ip}:{port}"
+        peer_conn = AsyncPeerConnection(
+            self.peer_engine,
+            ip, port,
+            self.torrent_metadata['info_hash'],
+            self.peer_id,
+            self.piece_manager,
+            self.scheduler,
+            min_requests=self.min_requests,
+            max_requests=self.max_requests,
+            connect_timeout=ConnectionManager.CONNECT_TIMEOUT
+        )
+        peer_conn.on_interested = self.choker.peer_interested
+        
+        def on_connected(future):
+            if not future.cancelled() and future.exception() is None and future.result():
+                print(f"Connected to peer: {peer_key}")
+                self.connection_manager.connection_made(peer_conn)
+            else:
+                self.connection_manager.connection_failed(ip, port)
+        
+        self.peer_engine.submit(peer_conn.connect_async()).add_done_callback(on_connected)
     
-    def _cleanup_dead_connections(self):
-        dead_peers = []
-        for peer_key, peer_conn in self.peer_connections.items():
-            if not peer_conn.connected:
-                dead_peers.append(peer_key)
-        
-        for peer_key in dead_peers:
-            del self.peer_connections[peer_key]
+    def _accept_peer(self, sock, address: Tuple[str, int]):
+        # Called on the listener thread; the handshake is read on a thread of its own
+        ip, port = address
+        if not self.running or not self.connection_manager.reserve_inbound(ip, port):
+            sock.close()
+            return
+        
+        peer_conn = PeerConnection(
+            ip, port,
+            self.torrent_metadata['info_hash'],
+            self.peer_id,
+            self.piece_manager,
+            self.scheduler,
+            min_requests=self.min_requests,
+            max_requests=self.max_requests,
+            connect_timeout=ConnectionManager.CONNECT_TIMEOUT
+        )
+        peer_conn.on_interested = self.choker.peer_interested
+        
+        def handshake():
+            if peer_conn.accept(sock):
+                print(f"Accepted peer: {ip}:{port}")
+                self.connection_manager.connection_made(peer_conn)
+            else:
+                self.connection_manager.connection_failed(ip, port, inbound=True)
+        
+        threading.Thread(target=handshake, daemon=True).start()
+    
+    async def _accept_peer_async(self, reader, writer):
+        # Connection handler of the asyncio listener, runs on the event loop
+        ip, port = writer.get_extra_info('peername')[:2]
+        if not self.running or not self.connection_manager.reserve_inbound(ip, port):
+            writer.close()
+            return
+        
+        peer_conn = AsyncPeerConnection(
+            self.peer_engine,
+            ip, port,
+            self.torrent_metadata['info_hash'],
+            self.peer_id,
+            self.piece_manager,
+            self.scheduler,
+            min_requests=self.min_requests,
+            max_requests=self.max_requests,
+            connect_timeout=ConnectionManager.CONNECT_TIMEOUT
+        )
+        peer_conn.on_interested = self.choker.peer_interested
+        
+        if await peer_conn.accept_async(reader, writer):
+            print(f"Accepted peer: {ip}:{port}")
+            self.connection_manager.connection_made(peer_conn)
+        else:
+            self.connection_manager.connection_failed(ip, port, inbound=True)
     
     def _on_piece_received(self, piece_index: int):
+        self.piece_picker.piece_completed(piece_index)
+        
+        # Advertise the new piece so peers can request it from us
+        if self.connection_manager:
+            for peer_conn in self.connection_manager.get_connections():
+                peer_conn.send_have(piece_index)
+        
         completion = self.piece_manager.get_completion_percentage()
-        completed_pieces = sum(self.piece_manager.completed_pieces)
+        completed_pieces = self.piece_manager.completed_count
         total_pieces = self.piece_manager.num_pieces
         print(f"[✓] Completed piece {piece_index} ({completed_pieces}/{total_pieces}) - Progress: {completion:.3f}%")
         
-        # Check if download is complete
+        # Check if download is complete. This runs on the disk writer thread, which
+        # stop_download() drains, so the status loop does the stopping.
         if completion >= 100.0:
             print("Download completed!")
-            self.stop_download()
+            self.download_complete.set()
 
     def _status_loop(self):
+        last_resume_save = time.time()
+        saved_pieces = self.piece_manager.completed_count
+        
         while self.running:
+            # Periodically persist piece state so a crash loses little progress
+            if time.time() - last_resume_save >= self.resume_interval:
+                completed_pieces = self.piece_manager.completed_count
+                if completed_pieces != saved_pieces and self.resume_data.save():
+                    saved_pieces = completed_pieces
+                last_resume_save = time.time()
+            
             if self.piece_manager:
                 completion = self.piece_manager.get_completion_percentage()
-                completed_pieces = sum(self.piece_manager.completed_pieces)
+                completed_pieces = self.piece_manager.completed_count
                 total_pieces = self.piece_manager.num_pieces
-                active_peers = len([p for p in self.peer_connections.values() if p.connected])
-                total_peers = len(self.peer_connections)
+                peer_conns = self.connection_manager.get_connections()
+                active_peers = len([p for p in peer_conns if p.connected])
+                total_peers = len(peer_conns)
                 bytes_left = self._get_bytes_left()
                 downloaded_bytes = self.torrent_metadata['total_length'] - bytes_left
                 print(f"Progress: {completion:.3f}% ({completed_pieces}/{total_pieces} pieces) | Downloaded: {downloaded_bytes:,} bytes | Peers: {active_peers}/{total_peers} | Remaining: {bytes_left:,} bytes")
             
-            time.sleep(10)
+            if self.download_complete.wait(timeout=10):
+                self.stop_download()
+                return
 
     def get_status(self) -> Dict[str, Any]:
         if not self.piece_manager:
             return {"status": "No torrent loaded"}
         
+        peer_conns = self.connection_manager.get_connections() if self.connection_manager else []
+        connection_stats = self.connection_manager.get_stats() if self.connection_manager else {}
+        disk_stats = self.piece_manager.disk_writer.get_stats()
+        cache_stats = self.piece_manager.read_cache.get_stats()
+        scheduler_stats = self.scheduler.get_stats()
+        choker_stats = self.choker.get_stats() if self.choker else {}
+        downloaded = sum(p.downloaded for p in peer_conns)
         return {
             "completion": self.piece_manager.get_completion_percentage(),
-            "active_peers": len([p for p in self.peer_connections.values() if p.connected]),
-            "total_peers": len(self.peer_connections),
+            "active_peers": len([p for p in peer_conns if p.connected]),
+            "total_peers": len(peer_conns),
             "bytes_left": self._get_bytes_left(),
-            "total_size": self.torrent_metadata['total_length']
+            "total_size": self.torrent_metadata['total_length'],
+            "disk_queue_depth": disk_stats['queue_depth'],
+            "disk_write_latency_ms": disk_stats['avg_latency_ms'],
+            "read_cache_hits": cache_stats['hits'],
+            "read_cache_misses": cache_stats['misses'],
+            "duplicate_ratio": scheduler_stats['duplicate_ratio'],
+            "avg_request_depth": (sum(p.pipeline.depth for p in peer_conns) / len(peer_conns)
+                                  if peer_conns else 0.0),
+            "snubbed_peers": len([p for p in peer_conns if p.snubbed]),
+            "released_blocks": scheduler_stats['released_blocks'],
+            "inbound_peers": connection_stats.get('inbound', 0),
+            "listen_port": self.listener.port if self.listener else None,
+            "pending_connections": connection_stats.get('pending', 0),
+            "peer_candidates": connection_stats.get('candidates', 0),
+            "replaced_peers": connection_stats.get('replaced', 0),
+            "unchoked_peers": choker_stats.get('unchoked', 0),
+            "interested_peers": choker_stats.get('interested', 0),
+            "uploaded": self.connection_manager.uploaded() if self.connection_manager else 0,
+            # Socket reads and writes of the current connections per MB they delivered
+            "syscalls_per_mb": (sum(p.syscalls for p in peer_conns) / (downloaded / 1e6)
+                                if downloaded else 0.0)
         }
 
 def main():
@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+class Choker:
+    """Decides which interested peers may download from us (tit-for-tat).
+    
+    Every CHOKE_INTERVAL the upload_slots fastest peers are unchoked: fastest by
+    their download rate to us while leeching, by our upload rate to them while
+    seeding. One optimistic slot rotates every OPTIMISTIC_INTERVAL to a random
+    choked peer, favouring new ones, so peers we have not traded with yet get a
+    chance to show their rate. Everyone else is choked.
+    """
+    
+    CHOKE_INTERVAL = 10
+    OPTIMISTIC_INTERVAL = 30
+    NEW_PEER_AGE = 60  # Peers seen for less than this are NEW_PEER_WEIGHT times likelier
+    NEW_PEER_WEIGHT = 3  # to get the optimistic slot
+    
+    def __init__(self, get_peers: Callable[[], List], is_seeding: Callable[[], bool], upload_slots: int = 4):
+        self.get_peers = get_peers
+        self.is_seeding = is_seeding
+        self.upload_slots = upload_slots
+        
+        self.unchoked = set()  # Peers we unchoked, including ones not yet registered as connections
+        self.optimistic = None  # Peer holding the optimistic slot
+        self.next_optimistic = 0.0
+        self.last_bytes = {}  # peer -> (downloaded, uploaded) at the last rechoke
+        self.rates = {}  # peer -> bytes/s over the last interval, in the direction that counts
+        self.first_seen = {}  # peer -> time the choker first saw it
+        self.last_rechoke = time.time()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._choke_loop, daemon=True, name="choker")
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    def peer_interested(self, peer):
+        # Fill a free upload slot right away rather than at the next rechoke
+        with self.lock:
+            self.unchoked = {p for p in self.unchoked if p.connected and not p.peer_choked}
+            if len(self.unchoked) >= self.upload_slots + 1:
+                return
+            self.unchoked.add(peer)
+        peer.unchoke()
+    
+    def rechoke(self):
+        now = time.time()
+        peers = [peer for peer in self.get_peers() if peer.connected]
+        seeding = self.is_seeding()
+        
+        with self.lock:
+            elapsed = max(now - self.last_rechoke, 1e-3)
+            self.last_rechoke = now
+            
+            rates = {}
+            last_bytes = {}
+            for peer in peers:
+                transferred = (peer.downloaded, peer.uploaded)
+                previous = self.last_bytes.get(peer, transferred)
+                direction = 1 if seeding else 0
+                rates[peer] = (transferred[direction] - previous[direction]) / elapsed
+                last_bytes[peer] = transferred
+                self.first_seen.setdefault(peer, now)
+            self.rates = rates
+            self.last_bytes = last_bytes
+            self.first_seen = {peer: self.first_seen[peer] for peer in peers}
+            
+            # Regular slots: the fastest interested peers. A snubbed peer sends us nothing, so
+            # while leeching it only gets the optimistic slot. Shuffling first breaks rate ties.
+            interested = [peer for peer in peers if peer.peer_interested]
+            random.shuffle(interested)
+            ranked = sorted((peer for peer in interested if seeding or not peer.snubbed),
+                            key=lambda peer: rates[peer], reverse=True)
+            unchoke = set(ranked[:self.upload_slots])
+            
+            # Optimistic slot: keep the current holder until its time is up
+            optimistic = self.optimistic
+            if (now >= self.next_optimistic or optimistic not in interested or optimistic in unchoke):
+                candidates = [peer for peer in interested if peer not in unchoke]
+                if candidates:
+                    weights = [self.NEW_PEER_WEIGHT if now - self.first_seen[peer] < self.NEW_PEER_AGE else 1
+                               for peer in candidates]
+                    optimistic = random.choices(candidates, weights=weights)[0]
+                else:
+                    optimistic = None
+                self.next_optimistic = now + self.OPTIMISTIC_INTERVAL
+            self.optimistic = optimistic
+            if optimistic is not None:
+                unchoke.add(optimistic)
+            self.unchoked = unchoke
+        
+        for peer in peers:
+            if peer in unchoke:
+                peer.unchoke()
+            else:
+                peer.choke()
+    
+    def get_stats(self) -> Dict[str, int]:
+        peers = self.get_peers()
+        return {
+            "unchoked": len([peer for peer in peers if not peer.peer_choked]),
+            "interested": len([peer for peer in peers if peer.peer_interested])
+        }
+    
+    def _choke_loop(self):
+        while self.running:
+            try:
+                self.rechoke()
+            except Exception as e:
+                print(f"Choker error: {e}")
+            self.wakeup.wait(timeout=self.CHOKE_INTERVAL)
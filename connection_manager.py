@@ -0,0 +1,260 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+class PeerCandidate:
+    """Dial history of one peer address."""
+    
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.failures = 0  # Consecutive failed dials or sessions that ended at once
+        self.retry_at = 0.0  # Not dialed again before this
+
+class ConnectionManager:
+    """Keeps up to max_connections peers connected, dialing candidates concurrently.
+    
+    Up to MAX_PENDING dials run at once. dial(ip, port) must not block; it reports
+    back through connection_made() or connection_failed(). Failed peers are retried
+    with exponential backoff. Every SCORE_INTERVAL each connection's download rate
+    is measured, and at the cap the slowest connection past its grace period is
+    replaced by a waiting candidate if it is well below the mean.
+    
+    Inbound connections from the listener share max_connections but have quotas of
+    their own: dialing stops at max_outbound, leaving room for peers that reach us,
+    and at most max_inbound are accepted, leaving room to dial.
+    """
+    
+    MAX_PENDING = 20
+    CONNECT_TIMEOUT = 4  # Seconds for the TCP connect and again for the handshake
+    MIN_BACKOFF = 30
+    MAX_BACKOFF = 3600
+    MAX_FAILURES = 6  # Candidates are forgotten after this many consecutive failures
+    MAX_CANDIDATES = 2000
+    SCORE_INTERVAL = 10
+    GRACE_PERIOD = 30  # New connections are not replaced, and count as failed if they drop this early
+    REPLACE_FRACTION = 0.5  # Only connections slower than this share of the mean rate are replaced
+    
+    def __init__(self, dial: Callable[[str, int], None], max_connections: int = 50,
+                 max_outbound: Optional[int] = None, max_inbound: Optional[int] = None):
+        self.dial = dial
+        self.max_connections = max_connections
+        self.max_outbound = max_outbound if max_outbound is not None else max_connections - max_connections // 5
+        self.max_inbound = max_inbound if max_inbound is not None else max_connections // 2
+        
+        self.candidates: Dict[Tuple[str, int], PeerCandidate] = {}
+        self.connections = {}  # (ip, port) -> established PeerConnection
+        self.pending = set()  # (ip, port) being dialed
+        self.inbound = set()  # (ip, port) of connections the peer opened
+        self.inbound_pending = set()  # (ip, port) accepted, handshake not yet read
+        self.connected_at = {}  # (ip, port) -> time the handshake completed
+        self.last_downloaded = {}  # (ip, port) -> downloaded bytes at the last scoring round
+        self.rates = {}  # (ip, port) -> bytes/s over the last scoring round
+        self.replacing = set()  # (ip, port) disconnected to make room for a candidate
+        self.replaced = 0
+        self.closed_uploaded = 0  # Bytes uploaded by connections that have since closed
+        self.last_score = time.time()
+        self.lock = threading.Lock()
+        self.running = True
+    
+    def add_peers(self, peers: List[Dict]):
+        with self.lock:
+            for peer in peers:
+                key = (peer['ip'], peer['port'])
+                if key not in self.candidates and len(self.candidates) < self.MAX_CANDIDATES:
+                    self.candidates[key] = PeerCandidate(peer['ip'], peer['port'])
+        self._fill()
+    
+    def reserve_inbound(self, ip: str, port: int) -> bool:
+        # Called by the listener before reading the handshake; False means hang up
+        with self.lock:
+            if (not self.running
+                    or len(self.inbound) + len(self.inbound_pending) >= self.max_inbound
+                    or len(self.connections) + len(self.pending) + len(self.inbound_pending) >= self.max_connections):
+                return False
+            self.inbound_pending.add((ip, port))
+            return True
+    
+    def connection_made(self, peer_conn):
+        key = (peer_conn.peer_ip, peer_conn.peer_port)
+        with self.lock:
+            self.pending.discard(key)
+            self.inbound_pending.discard(key)
+            accepted = (self.running and key not in self.connections
+                        and len(self.connections) < self.max_connections)
+            if accepted:
+                if peer_conn.inbound:
+                    self.inbound.add(key)
+                self.connections[key] = peer_conn
+                self.connected_at[key] = time.time()
+                self.last_downloaded[key] = peer_conn.downloaded
+                peer_conn.on_disconnect = self._on_disconnect
+        
+        if not accepted:
+            peer_conn.disconnect()
+        elif not peer_conn.connected:
+            # Dropped before the callback was attached
+            self._on_disconnect(peer_conn)
+    
+    def connection_failed(self, ip: str, port: int, inbound: bool = False):
+        with self.lock:
+            if inbound:
+                self.inbound_pending.discard((ip, port))
+            else:
+                self.pending.discard((ip, port))
+                self._record_failure((ip, port))
+        self._fill()
+    
+    def maintain(self):
+        # Called periodically: rescores connections and dials candidates whose backoff ran out
+        if time.time() - self.last_score >= self.SCORE_INTERVAL:
+            self._rescore()
+        self._fill()
+    
+    def stop(self):
+        with self.lock:
+            self.running = False
+            peer_conns = list(self.connections.values())
+            self.connections.clear()
+            self.pending.clear()
+            self.inbound.clear()
+            self.inbound_pending.clear()
+        for peer_conn in peer_conns:
+            peer_conn.disconnect()
+        with self.lock:
+            self.closed_uploaded += sum(peer_conn.uploaded for peer_conn in peer_conns)
+    
+    def get_connections(self) -> List:
+        with self.lock:
+            return list(self.connections.values())
+    
+    def is_idle(self) -> bool:
+        # Nothing connected and nothing being dialed
+        with self.lock:
+            return not self.connections and not self.pending
+    
+    def uploaded(self) -> int:
+        # Running upload total for tracker announces, including connections that have closed
+        with self.lock:
+            return self.closed_uploaded + sum(peer_conn.uploaded for peer_conn in self.connections.values())
+    
+    def get_stats(self) -> Dict[str, int]:
+        now = time.time()
+        with self.lock:
+            return {
+                "connected": len(self.connections),
+                "inbound": len(self.inbound),
+                "pending": len(self.pending),
+                "candidates": len(self.candidates),
+                "backing_off": len([c for c in self.candidates.values() if c.retry_at > now]),
+                "replaced": self.replaced
+            }
+    
+    def _fill(self):
+        now = time.time()
+        with self.lock:
+            if not self.running:
+                return
+            slots = min(self._room(), self.MAX_PENDING - len(self.pending))
+            if slots <= 0:
+                return
+            
+            # Peers with the cleanest history first, random among equals
+            eligible = self._eligible(now)
+            random.shuffle(eligible)
+            eligible.sort(key=lambda candidate: candidate.failures)
+            to_dial = eligible[:slots]
+            for candidate in to_dial:
+                self.pending.add((candidate.ip, candidate.port))
+        
+        for candidate in to_dial:
+            self.dial(candidate.ip, candidate.port)
+    
+    def _outbound_room(self) -> int:
+        # Caller holds the lock
+        return self.max_outbound - (len(self.connections) - len(self.inbound)) - len(self.pending)
+    
+    def _room(self) -> int:
+        # Dials that may start now under both the outbound quota and the overall cap
+        total = len(self.connections) + len(self.pending) + len(self.inbound_pending)
+        return min(self._outbound_room(), self.max_connections - total)
+    
+    def _eligible(self, now: float) -> List[PeerCandidate]:
+        return [candidate for key, candidate in self.candidates.items()
+                if candidate.retry_at <= now and key not in self.connections and key not in self.pending]
+    
+    def _on_disconnect(self, peer_conn):
+        key = (peer_conn.peer_ip, peer_conn.peer_port)
+        now = time.time()
+        with self.lock:
+            # disconnect() may run more than once, or for a connection already replaced
+            if self.connections.get(key) is not peer_conn:
+                return
+            del self.connections[key]
+            self.closed_uploaded += peer_conn.uploaded
+            self.inbound.discard(key)
+            connected_at = self.connected_at.pop(key, now)
+            self.last_downloaded.pop(key, None)
+            self.rates.pop(key, None)
+            
+            candidate = self.candidates.get(key)
+            if key in self.replacing:
+                self.replacing.discard(key)
+                if candidate:
+                    candidate.retry_at = now + self.MAX_BACKOFF
+            elif peer_conn.downloaded == 0 and now - connected_at < self.GRACE_PERIOD:
+                self._record_failure(key)
+            elif candidate:
+                candidate.failures = 0
+                candidate.retry_at = now + self.MIN_BACKOFF
+        
+        self._fill()
+    
+    def _record_failure(self, key: Tuple[str, int]):
+        # Caller holds the lock
+        candidate = self.candidates.get(key)
+        if candidate is None:
+            return
+        candidate.failures += 1
+        if candidate.failures >= self.MAX_FAILURES:
+            del self.candidates[key]
+            return
+        candidate.retry_at = time.time() + min(self.MIN_BACKOFF * 2 ** (candidate.failures - 1),
+                                               self.MAX_BACKOFF)
+    
+    def _rescore(self):
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.last_score, 1e-3)
+            self.last_score = now
+            for key, peer_conn in self.connections.items():
+                downloaded = peer_conn.downloaded
+                self.rates[key] = (downloaded - self.last_downloaded.get(key, downloaded)) / elapsed
+                self.last_downloaded[key] = downloaded
+            
+            # Only worth churning when the cap is what keeps a candidate waiting. If the
+            # outbound quota is what is full, only an outbound connection frees a dial.
+            if self._room() > 0 or not self._eligible(now):
+                return
+            outbound_only = self._outbound_room() <= 0
+            
+            settled = [key for key in self.connections
+                       if now - self.connected_at.get(key, now) >= self.GRACE_PERIOD
+                       and key not in self.replacing
+                       and not (outbound_only and key in self.inbound)]
+            if not settled:
+                return
+            worst_key = min(settled, key=lambda key: self.rates.get(key, 0.0))
+            mean_rate = sum(self.rates.values()) / len(self.rates)
+            if self.rates.get(worst_key, 0.0) >= self.REPLACE_FRACTION * mean_rate and mean_rate > 0:
+                return
+            worst = self.connections[worst_key]
+            self.replacing.add(worst_key)
+            self.replaced += 1
+        
+        print(f"Replacing slowest peer {worst.peer_ip}:{worst.peer_port} "
+              f"({self.rates.get(worst_key, 0.0) / 1024:.1f} KB/s)")
+        worst.disconnect()
+        # A connection that had already died reports nothing from disconnect()
+        self._on_disconnect(worst)
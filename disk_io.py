@@ -0,0 +1,320 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional
+from storage import Storage
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')  # Most buffers a single pwritev accepts
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+class WriteJob:
+    __slots__ = ('offset', 'data', 'callback', 'queued_at')
+    
+    def __init__(self, offset: int, data: memoryview, callback: Optional[Callable]):
+        self.offset = offset  # Absolute offset in the torrent
+        self.data = data
+        self.callback = callback
+        self.queued_at = time.time()
+
+class DiskWriter:
+    """Write-behind disk writer: a bounded queue drained by one writer thread.
+    
+    Queued writes are sorted and adjacent ones in the same file are coalesced
+    into a single storage write (one os.pwritev for FileStorage). submit()
+    blocks once the queue is full.
+    """
+    
+    def __init__(self, storage: Storage, max_queued: int = 64, max_batch: int = 32,
+                 fsync_interval: Optional[float] = None):
+        self.storage = storage
+        self.max_queued = max_queued
+        self.max_batch = max_batch
+        self.fsync_interval = fsync_interval  # None leaves flushing to the OS
+        
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.dirty_files = set()
+        self.last_fsync = time.time()
+        
+        self.writes = 0
+        self.bytes_written = 0
+        self.write_calls = 0
+        self.fsyncs = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.stats_lock = threading.Lock()
+        
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True, name="disk-writer")
+        self.thread.start()
+    
+    def submit(self, offset: int, data: memoryview, callback: Callable = None):
+        # callback(success) runs on the writer thread once the data is on disk
+        self.queue.put(WriteJob(offset, data, callback))
+    
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+    
+    def is_congested(self) -> bool:
+        # Piece pickers stop starting new pieces above this mark
+        return self.queue.qsize() >= self.max_queued * 3 // 4
+    
+    def get_stats(self) -> Dict:
+        with self.stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "writes": self.writes,
+                "bytes_written": self.bytes_written,
+                "write_calls": self.write_calls,
+                "fsyncs": self.fsyncs,
+                "avg_latency_ms": self.total_latency / self.writes * 1000 if self.writes else 0.0,
+                "max_latency_ms": self.max_latency * 1000
+            }
+    
+    def flush(self):
+        self.queue.join()
+        self._fsync_dirty_files()
+    
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+    
+    def _writer_loop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            
+            # Drain whatever else is already queued so it can be coalesced
+            batch = [job]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    next_job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_job is None:
+                    stop = True
+                    break
+                batch.append(next_job)
+            
+            self._write_batch(batch)
+            
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+    
+    def _write_batch(self, batch: List[WriteJob]):
+        # Split every job into per-file spans, then sort so neighbours in a file are adjacent
+        spans = []
+        for job in batch:
+            data_offset = 0
+            for file_index, file_offset, span_length in self.storage.file_index.spans(job.offset, len(job.data)):
+                spans.append((file_index, file_offset, job.data[data_offset:data_offset + span_length], job))
+                data_offset += span_length
+        spans.sort(key=lambda span: (span[0], span[1]))
+        
+        failed = set()
+        group = []
+        for span in spans:
+            if group and (span[0] != group[-1][0]
+                          or span[1] != group[-1][1] + len(group[-1][2])
+                          or len(group) >= IOV_MAX):
+                self._write_group(group, failed)
+                group = []
+            group.append(span)
+        if group:
+            self._write_group(group, failed)
+        
+        if self.fsync_interval is not None and time.time() - self.last_fsync >= self.fsync_interval:
+            self._fsync_dirty_files()
+        
+        now = time.time()
+        with self.stats_lock:
+            for job in batch:
+                latency = now - job.queued_at
+                self.writes += 1
+                self.bytes_written += len(job.data)
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+        
+        for job in batch:
+            if job.callback:
+                try:
+                    job.callback(id(job) not in failed)
+                except Exception as e:
+                    print(f"Disk write callback error: {e}")
+    
+    def _write_group(self, group: List, failed: set):
+        file_index, file_offset = group[0][0], group[0][1]
+        
+        try:
+            write_calls = self.storage.write_file(file_index, file_offset, [span[2] for span in group])
+            with self.stats_lock:
+                self.write_calls += write_calls
+            self.dirty_files.add(file_index)
+        except (OSError, ValueError) as e:
+            print(f"Disk write error: {e}")
+            for span in group:
+                failed.add(id(span[3]))
+    
+    def _fsync_dirty_files(self):
+        dirty_files, self.dirty_files = self.dirty_files, set()
+        for file_index in dirty_files:
+            try:
+                self.storage.flush(file_index)
+                with self.stats_lock:
+                    self.fsyncs += 1
+            except OSError as e:
+                print(f"Disk fsync error: {e}")
+        self.last_fsync = time.time()
+
+class ReadCache:
+    """Bounded LRU cache of whole pieces in front of disk reads for seeding.
+
+    A miss loads the entire piece, or waits for a load of it already under way; a
+    requester that moves on to the next piece triggers background readahead of the
+    pieces after it.
+    """
+    
+    MAX_TRACKED_REQUESTERS = 1024
+    
+    def __init__(self, load_piece: Callable[[int], Optional[bytes]], num_pieces: int,
+                 max_bytes: int = 64 * 1024 * 1024, readahead: int = 2):
+        self.load_piece = load_piece
+        self.num_pieces = num_pieces
+        self.max_bytes = max_bytes
+        self.readahead = readahead
+        
+        self.pieces = OrderedDict()  # piece_index -> bytes, least recently used first
+        self.cached_bytes = 0
+        self.loading = {}  # piece_index -> Event set once the read in progress is done
+        self.last_piece = OrderedDict()  # requester -> last piece it read
+        self.lock = threading.Lock()
+        self.readahead_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="readahead")
+        
+        self.hits = 0
+        self.misses = 0
+        self.readaheads = 0
+    
+    def get_block(self, piece_index: int, offset: int, length: int,
+                  requester: Hashable = None) -> Optional[memoryview]:
+        loading = None
+        with self.lock:
+            piece_data = self.pieces.get(piece_index)
+            if piece_data is not None:
+                self.pieces.move_to_end(piece_index)
+                self.hits += 1
+            else:
+                self.misses += 1
+                loading = self.loading.get(piece_index)
+                if loading is None:
+                    self.loading[piece_index] = threading.Event()
+            start_readahead = self._is_sequential(requester, piece_index)
+        
+        if piece_data is None:
+            if loading is None:
+                piece_data = self._load(piece_index)
+            else:
+                # Readahead or another requester is reading it already
+                loading.wait()
+                with self.lock:
+                    piece_data = self.pieces.get(piece_index)
+                if piece_data is None:
+                    # That read failed, or the piece is too large to cache
+                    piece_data = self.load_piece(piece_index)
+            if piece_data is None:
+                return None
+        
+        if start_readahead:
+            self._schedule_readahead(piece_index)
+        
+        return memoryview(piece_data)[offset:offset + length]
+    
+    def contains(self, piece_index: int) -> bool:
+        with self.lock:
+            return piece_index in self.pieces
+    
+    def invalidate(self, piece_index: int):
+        # The piece is no longer complete on disk, e.g. a recheck found it corrupt
+        with self.lock:
+            piece_data = self.pieces.pop(piece_index, None)
+            if piece_data is not None:
+                self.cached_bytes -= len(piece_data)
+    
+    def get_stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "readaheads": self.readaheads,
+                "cached_pieces": len(self.pieces),
+                "cached_bytes": self.cached_bytes
+            }
+    
+    def close(self):
+        self.readahead_pool.shutdown(wait=False)
+    
+    def _is_sequential(self, requester: Hashable, piece_index: int) -> bool:
+        # Called with the lock held
+        if requester is None or self.readahead <= 0:
+            return False
+        
+        previous = self.last_piece.pop(requester, None)
+        self.last_piece[requester] = piece_index
+        if len(self.last_piece) > self.MAX_TRACKED_REQUESTERS:
+            self.last_piece.popitem(last=False)
+        return previous == piece_index - 1
+    
+    def _insert(self, piece_index: int, piece_data: bytes):
+        if len(piece_data) > self.max_bytes:
+            return
+        
+        with self.lock:
+            if piece_index in self.pieces:
+                return
+            self.pieces[piece_index] = piece_data
+            self.cached_bytes += len(piece_data)
+            while self.cached_bytes > self.max_bytes:
+                _, evicted = self.pieces.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+    
+    def _schedule_readahead(self, piece_index: int):
+        with self.lock:
+            to_load = [i for i in range(piece_index + 1, min(piece_index + 1 + self.readahead, self.num_pieces))
+                       if i not in self.pieces and i not in self.loading]
+            for i in to_load:
+                self.loading[i] = threading.Event()
+        
+        for i in to_load:
+            try:
+                self.readahead_pool.submit(self._readahead_piece, i)
+            except RuntimeError:
+                # Closed: nobody may be left waiting on a load that will never run
+                with self.lock:
+                    self.loading.pop(i).set()
+    
+    def _readahead_piece(self, piece_index: int):
+        if self._load(piece_index) is not None:
+            with self.lock:
+                self.readaheads += 1
+    
+    def _load(self, piece_index: int) -> Optional[bytes]:
+        # Reads a piece registered in self.loading and wakes whoever waits on it
+        try:
+            piece_data = self.load_piece(piece_index)
+            if piece_data is not None:
+                self._insert(piece_index, piece_data)
+            return piece_data
+        finally:
+            with self.lock:
+                self.loading.pop(piece_index).set()
@@ -1,63 +1,256 @@
+import os
+import select
 import socket
 import struct
 import threading
 import time
-from typing import Dict, List, Optional, Callable
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Callable, Dict, List, Optional
 import hashlib
+from bitfield import Bitfield
+from piece_manager import BLOCK_SIZE
+
+class MessageReader:
+    """Frames length-prefixed peer messages out of one reusable receive buffer.
+
+    Data is read with recv_into and messages are returned as memoryview slices
+    of the buffer, so a view is only valid until the next read call.
+    """
+    
+    MAX_MESSAGE_LENGTH = 1 << 24  # Larger than any bitfield or block we accept
+    
+    def __init__(self, sock: socket.socket, buffer_size: int = 256 * 1024):
+        self.socket = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unconsumed byte
+        self.end = 0  # End of received data
+        self.recv_calls = 0
+    
+    def read_exact(self, length: int) -> memoryview:
+        self._ensure(length)
+        data = self.view[self.start:self.start + length]
+        self.start += length
+        return data
+    
+    def read_message(self) -> memoryview:
+        # Returns the message body without its length prefix; empty for keep-alives
+        self._ensure(4)
+        length = struct.unpack_from('>I', self.buffer, self.start)[0]
+        if length > self.MAX_MESSAGE_LENGTH:
+            raise ValueError(f"Message too long: {length} bytes")
+        
+        self._ensure(4 + length)
+        message = self.view[self.start + 4:self.start + 4 + length]
+        self.start += 4 + length
+        return message
+    
+    def has_message(self) -> bool:
+        # Whether a complete message is already buffered, so the next read_message won't block
+        buffered = self.end - self.start
+        if buffered < 4:
+            return False
+        return buffered >= 4 + struct.unpack_from('>I', self.buffer, self.start)[0]
+    
+    def fill(self):
+        # One recv_into of whatever has arrived, for callers that wait with select() first
+        needed = self.end - self.start + 1
+        if self.end - self.start >= 4:
+            length = struct.unpack_from('>I', self.buffer, self.start)[0]
+            if length > self.MAX_MESSAGE_LENGTH:
+                raise ValueError(f"Message too long: {length} bytes")
+            needed = max(needed, 4 + length)
+        if self.start + needed > len(self.buffer):
+            self._make_room(needed)
+        self._recv()
+    
+    def _ensure(self, length: int):
+        while self.end - self.start < length:
+            if self.start + length > len(self.buffer):
+                self._make_room(length)
+            self._recv()
+    
+    def _recv(self):
+        received = self.socket.recv_into(self.view[self.end:])
+        self.recv_calls += 1
+        if received == 0:
+            raise ConnectionError("Connection closed by peer")
+        self.end += received
+    
+    def _make_room(self, length: int):
+        buffered = self.end - self.start
+        if length > len(self.buffer):
+            # Views handed out earlier keep the old buffer alive, so allocate a fresh one
+            buffer = bytearray(max(length, 2 * len(self.buffer)))
+            buffer[:buffered] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:buffered] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = buffered
+
+class FileBlock:
+    """Outbox entry for block data sent straight from the file with sendfile."""
+    
+    __slots__ = ('piece_index', 'offset', 'length')
+    
+    def __init__(self, piece_index: int, offset: int, length: int):
+        self.piece_index = piece_index
+        self.offset = offset
+        self.length = length  # Bytes not yet sent
+    
+    def __len__(self) -> int:
+        return self.length
+
+class RequestPipeline:
+    """Per-peer request queue depth sized to the link's bandwidth-delay product.
+    
+    Throughput is averaged over short windows and the round-trip time is the
+    lowest request-to-block delay seen recently, so queueing at the peer does
+    not inflate it. The target depth is twice throughput x RTT in blocks: on a
+    latency-bound link the depth roughly doubles every round trip until the
+    bandwidth is found, and on a slow peer it stays small.
+    """
+    
+    GAIN = 2.0
+    RATE_WINDOW = 0.5  # Seconds of data behind each throughput sample
+    MIN_RTT_WINDOW = 10.0  # Seconds a minimum RTT sample stays valid
+    MIN_REQUEST_TIMEOUT = 5.0
+    MAX_REQUEST_TIMEOUT = 30.0
+    
+    def __init__(self, min_depth: int = 2, max_depth: int = 256, initial_depth: int = 10):
+        self.min_depth = max(1, min_depth)
+        self.max_depth = max(self.min_depth, max_depth)
+        self.depth = min(max(initial_depth, self.min_depth), self.max_depth)
+        
+        self.throughput = 0.0  # Bytes per second, smoothed
+        self.min_rtt = None
+        self.min_rtt_at = 0.0
+        self.window_start = None
+        self.window_bytes = 0
+    
+    def block_received(self, length: int, sent_at: Optional[float]):
+        now = time.time()
+        
+        if sent_at is not None:
+            rtt = now - sent_at
+            if self.min_rtt is None or rtt <= self.min_rtt or now - self.min_rtt_at > self.MIN_RTT_WINDOW:
+                self.min_rtt = rtt
+                self.min_rtt_at = now
+        
+        if self.window_start is None:
+            self.window_start = now
+        self.window_bytes += length
+        elapsed = now - self.window_start
+        if elapsed < self.RATE_WINDOW:
+            return
+        
+        rate = self.window_bytes / elapsed
+        self.throughput = rate if not self.throughput else 0.5 * self.throughput + 0.5 * rate
+        self.window_start = now
+        self.window_bytes = 0
+        self._update_depth()
+    
+    def idle(self):
+        # Called before the first request after nothing was outstanding: the gap since the
+        # last block says nothing about the link
+        self.window_start = None
+        self.window_bytes = 0
+    
+    def request_timeout(self) -> float:
+        # Four times the expected wait of a request at the back of a full queue
+        if self.min_rtt is None or not self.throughput:
+            return self.MAX_REQUEST_TIMEOUT
+        expected = self.min_rtt + self.depth * BLOCK_SIZE / self.throughput
+        return min(max(4 * expected, self.MIN_REQUEST_TIMEOUT), self.MAX_REQUEST_TIMEOUT)
+    
+    def _update_depth(self):
+        if self.min_rtt is None:
+            return
+        bdp_blocks = self.GAIN * self.throughput * self.min_rtt / BLOCK_SIZE
+        self.depth = min(max(int(bdp_blocks) + 1, self.min_depth), self.max_depth)
 
 class PeerConnection:
     
+    MAX_QUEUED_UPLOADS = 256
+    TICK_INTERVAL = 1  # Seconds between request timeout checks
+    IDLE_TIMEOUT = 30  # Disconnect after this long without any message
+    SNUB_TIMEOUT = 15  # Unchoked, requests out, and no block for this long
+    SEND_TIMEOUT = 60  # Disconnect when queued output makes no progress for this long
+    HIGH_WATER = 1024 * 1024  # Queued outbound bytes past which sends flush at once and uploads wait
+    MAX_IOVECS = 1024  # Buffers per writev; IOV_MAX on Linux, BSD and macOS
+    
     def __init__(self, peer_ip: str, peer_port: int, info_hash: bytes, 
-                 peer_id: bytes, piece_manager, on_piece_received: Callable = None):
+                 peer_id: bytes, piece_manager, scheduler,
+                 min_requests: int = 2, max_requests: int = 256, connect_timeout: float = 10):
         self.peer_ip = peer_ip
         self.peer_port = peer_port
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.piece_manager = piece_manager
-        self.on_piece_received = on_piece_received
+        self.scheduler = scheduler
+        self.piece_picker = scheduler.piece_picker
+        self.connect_timeout = connect_timeout  # Covers the TCP connect and the handshake reply
+        self.on_disconnect: Optional[Callable[['PeerConnection'], None]] = None
+        self.on_interested: Optional[Callable[['PeerConnection'], None]] = None  # Peer became interested
         
         self.socket = None
+        self.reader = None
         self.connected = False
         self.handshaked = False
+        self.inbound = False  # The peer connected to our listener
         self.choked = True
         self.interested = False
         self.peer_choked = True
         self.peer_interested = False
-        self.peer_bitfield = None
+        self.peer_bitfield: Optional[Bitfield] = None
         
-        self.pending_requests = {}
+        self.pending_requests = {}  # (piece_index, offset) -> (length, time sent)
+        self.upload_queue = OrderedDict()  # (piece_index, offset, length) requested by the peer
+        self.pipeline = RequestPipeline(min_requests, max_requests)
+        self.expired = {}  # (piece_index, offset) dropped unanswered -> time it may be requested from this peer again
+        self.snubbed = False
+        self.last_received = time.time()
+        self.last_block_at = time.time()
+        self.next_tick = 0.0
+        self.downloaded = 0  # Bytes of blocks this peer delivered first
+        self.uploaded = 0  # Bytes of blocks sent to this peer
+        self.send_lock = threading.Lock()  # Guards the outbox; keeps other threads' messages out of a piece
+        self.outbox = deque()  # Queued outbound buffers, oldest first; the head may be partly sent
+        self.outbox_bytes = 0
+        self.send_progress_at = time.time()  # Last time the outbox was empty or shrank
+        self.batching = False  # The message loop is handling a batch and flushes the outbox after it
+        self.send_calls = 0  # Socket write syscalls
+        self.loop_thread = None
+        self.wake_reader = None  # Socket pair other threads use to wake the message loop
+        self.wake_writer = None
+        self.wake_pending = False
         self.running = False
-        self.max_pending_requests = 10
         
     def connect(self) -> bool:
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)
+            self.socket.settimeout(self.connect_timeout)
             self.socket.connect((self.peer_ip, self.peer_port))
+            self.reader = MessageReader(self.socket)
             self.connected = True
             print(f"[+] TCP Connected to {self.peer_ip}:{self.peer_port}")
             
             # Send handshake
             handshake = self._build_handshake()
-            self.socket.send(handshake)
+            self._send(handshake)
             print(f"[>] Sent Handshake to {self.peer_ip}:{self.peer_port}")
             
-            # Receive handshake response
-            response = self.socket.recv(68)
-            if len(response) != 68:
+            # Receive and verify handshake response
+            response = self._recv_exact(68)
+            if response is None or not self._valid_handshake(response):
+                self.disconnect()
                 return False
             
-            # Verify handshake
-            if response[28:48] != self.info_hash:
-                return False
-            
-            self.handshaked = True
-            self.socket.settimeout(30)
             print(f"[<] Received Handshake OK from {self.peer_ip}:{self.peer_port}")
-            
-            # Start message handling thread
-            self.running = True
-            threading.Thread(target=self._message_loop, daemon=True).start()
+            self._start_session()
             
             return True
             
@@ -66,10 +259,60 @@ class PeerConnection:
             self.disconnect()
             return False
     
+    def accept(self, sock: socket.socket) -> bool:
+        # Inbound: the peer sends its handshake first; ours goes back only if the info_hash is ours
+        try:
+            self.socket = sock
+            self.socket.settimeout(self.connect_timeout)
+            self.reader = MessageReader(self.socket)
+            self.connected = True
+            self.inbound = True
+            
+            response = self._recv_exact(68)
+            if response is None or not self._valid_handshake(response):
+                self.disconnect()
+                return False
+            
+            self._send(self._build_handshake())
+            print(f"[<] Accepted Handshake from {self.peer_ip}:{self.peer_port}")
+            self._start_session()
+            
+            return True
+            
+        except Exception as e:
+            print(f"Inbound connection error from {self.peer_ip}:{self.peer_port}: {e}")
+            self.disconnect()
+            return False
+    
+    def _valid_handshake(self, handshake: bytes) -> bool:
+        return (handshake[0] == 19 and handshake[1:20] == b"BitTorrent protocol"
+                and handshake[28:48] == self.info_hash)
+    
+    def _start_session(self):
+        # Handshake done in either direction: advertise our pieces and start the message loop
+        self.handshaked = True
+        if self.socket:
+            # A socket with a timeout is non-blocking underneath, so writev and sendfile
+            # return short instead of stalling; the message loop waits in select()
+            self.socket.settimeout(self.TICK_INTERVAL)
+        self._send_bitfield()
+        self.running = True
+        self._start_message_loop()
+    
     def disconnect(self):
+        was_handshaked = self.handshaked
         self.running = False
         self.connected = False
         self.handshaked = False
+        
+        # Hand our claimed blocks back and withdraw this peer's pieces from the availability counts
+        self.scheduler.release_peer(self)
+        self.pending_requests.clear()
+        self.expired.clear()
+        self.upload_queue.clear()
+        peer_bitfield, self.peer_bitfield = self.peer_bitfield, None
+        if peer_bitfield is not None:
+            self.piece_picker.remove_peer(peer_bitfield)
         if self.connected:
             print(f"[-] Disconnected from {self.peer_ip}:{self.peer_port}")
         if self.socket:
@@ -78,6 +321,111 @@ class PeerConnection:
             except:
                 pass
             self.socket = None
+        
+        # Only established connections are reported; a failed connect() returns False instead
+        if was_handshaked and self.on_disconnect:
+            self.on_disconnect(self)
+    
+    def _start_message_loop(self):
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.loop_thread = threading.Thread(target=self._message_loop, daemon=True)
+        self.loop_thread.start()
+    
+    @property
+    def syscalls(self) -> int:
+        # Socket reads and writes so far, for syscalls per MB
+        reader = self.reader
+        return self.send_calls + (reader.recv_calls if reader else 0)
+    
+    def _send(self, *buffers):
+        # Queues the buffers as one message. Inside a batch of the message loop they go out
+        # with its flush, coalesced with the batch's other replies; otherwise right away.
+        # Whatever the socket has no room for is flushed by the message loop later.
+        with self.send_lock:
+            self._queue(buffers)
+            if self.loop_thread is not None and threading.current_thread() is not self.loop_thread:
+                # From another thread (disk writer, choker, a peer in endgame) the message
+                # loop does the writing, so the caller never waits on this peer's socket
+                self._wake_loop()
+            elif not self.batching or self.outbox_bytes > self.HIGH_WATER:
+                self._flush_locked()
+    
+    def _queue(self, buffers):
+        if not self.outbox:
+            self.send_progress_at = time.time()
+        self.outbox.extend(buffers)
+        self.outbox_bytes += sum(len(buffer) for buffer in buffers)
+    
+    def _wake_loop(self):
+        # send_lock held; one byte wakes the loop for everything queued before it runs
+        if self.wake_pending or self.wake_writer is None:
+            return
+        self.wake_pending = True
+        try:
+            self.wake_writer.send(b'\0')
+        except OSError:
+            pass
+    
+    def _end_batch(self):
+        with self.send_lock:
+            self.batching = False
+            self._flush_locked()
+    
+    def _backlog(self) -> int:
+        # Outbound bytes not yet handed to the kernel
+        return self.outbox_bytes
+    
+    def _flush_locked(self):
+        # Writes as much of the outbox as the socket takes, send_lock held. Each writev
+        # takes what fits; what was sent is trimmed off and, once the socket is full, the
+        # rest stays queued without blocking.
+        sock = self.socket
+        if sock is None:
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            raise ConnectionError("Not connected")
+        
+        while self.outbox:
+            head = self.outbox[0]
+            if type(head) is FileBlock:
+                written = self.piece_manager.send_block(sock.fileno(), head.piece_index, head.offset, head.length)
+            else:
+                # Buffers up to the next file block go out in one writev
+                buffers = []
+                for buffer in islice(self.outbox, self.MAX_IOVECS):
+                    if type(buffer) is FileBlock:
+                        break
+                    buffers.append(buffer)
+                written = self._write_buffers(sock, buffers)
+            self.send_calls += 1
+            if written == 0:
+                return
+            self.outbox_bytes -= written
+            self.send_progress_at = time.time()
+            
+            while written:
+                head = self.outbox[0]
+                if written < len(head):
+                    if type(head) is FileBlock:
+                        head.offset += written
+                        head.length -= written
+                    else:
+                        self.outbox[0] = memoryview(head)[written:]
+                    break
+                written -= len(head)
+                self.outbox.popleft()
+    
+    def _write_buffers(self, sock: socket.socket, buffers: List) -> int:
+        # One gathering write straight to the descriptor, which skips the poll a socket with
+        # a timeout does before each send; 0 when the socket is full
+        try:
+            if hasattr(os, 'writev'):
+                return os.writev(sock.fileno(), buffers)
+            return sock.send(b''.join(buffers))
+        except BlockingIOError:
+            return 0
     
     def _build_handshake(self) -> bytes:
         protocol = b"BitTorrent protocol"
@@ -87,45 +435,75 @@ class PeerConnection:
                           self.info_hash, self.peer_id)
     
     def _message_loop(self):
+        self.last_received = time.time()
+        
         while self.running and self.connected:
             try:
-                # Read message length
-                length_data = self._recv_exact(4)
-                if not length_data:
-                    break
-                
-                length = struct.unpack('>I', length_data)[0]
-                
-                if length == 0:
-                    # Keep-alive message
+                if time.time() >= self.next_tick:
+                    self.batching = True
+                    self._tick()
+                    self._end_batch()
                     continue
                 
-                # Read message
-                message_data = self._recv_exact(length)
-                if not message_data:
-                    break
+                # Wait for data or room for queued output; a partial message stays buffered
+                if not self.reader.has_message() and self._wait():
+                    self.reader.fill()
+                
+                # Replies to everything already received are queued and flushed together
+                self.batching = True
+                while self.running and self.reader.has_message():
+                    # Read the next length-prefixed message in place; empty ones are keep-alives
+                    message_data = self.reader.read_message()
+                    self.last_received = time.time()
+                    if len(message_data) > 0:
+                        self._handle_message(message_data)
                 
-                self._handle_message(message_data)
+                # Serve uploads once everything received so far is handled, so cancels in it count
+                if self.upload_queue:
+                    self._serve_uploads()
+                self._end_batch()
                 
+            except socket.timeout:
+                continue
+            except ConnectionError:
+                break
             except Exception as e:
-                print(f"Message loop error: {e}")
+                if self.running:  # Otherwise disconnect() closed the socket under us
+                    print(f"Message loop error: {e}")
                 break
         
         self.disconnect()
+        with self.send_lock:
+            self.wake_reader.close()
+            self.wake_writer.close()
+            self.wake_writer = None
     
-    def _recv_exact(self, length: int) -> Optional[bytes]:
-        data = b''
-        while len(data) < length:
-            try:
-                chunk = self.socket.recv(length - len(data))
-                if not chunk:
-                    return None
-                data += chunk
-            except:
-                return None
-        return data
+    def _wait(self) -> bool:
+        # Sleeps until the peer sends data, the socket has room for queued output, another
+        # thread queued a message or the next tick is due; flushes what it can and returns
+        # whether there is data to read
+        sock = self.socket
+        if sock is None:
+            raise ConnectionError("Not connected")
+        
+        timeout = max(0.0, self.next_tick - time.time())
+        readable, writable, _ = select.select([sock, self.wake_reader], [sock] if self.outbox else [], [], timeout)
+        woken = self.wake_reader in readable
+        if writable or woken:
+            with self.send_lock:
+                if woken:
+                    self.wake_reader.recv(64)
+                    self.wake_pending = False
+                self._flush_locked()
+        return sock in readable
+    
+    def _recv_exact(self, length: int) -> Optional[memoryview]:
+        try:
+            return self.reader.read_exact(length)
+        except:
+            return None
     
-    def _handle_message(self, message: bytes):
+    def _handle_message(self, message: memoryview):
         if len(message) == 0:
             return
         
@@ -135,28 +513,39 @@ class PeerConnection:
         if message_id == 0:  # choke
             self.choked = True
             print(f"[<] Peer choked us")
+            # A choking peer discards our outstanding requests; let other peers take them
+            self.scheduler.release_peer(self)
+            self.pending_requests.clear()
         elif message_id == 1:  # unchoke
             self.choked = False
             print(f"[<] Peer unchoked us")
             self._request_pieces()
         elif message_id == 2:  # interested
-            self.peer_interested = True
+            if not self.peer_interested:
+                self.peer_interested = True
+                if self.on_interested:
+                    self.on_interested(self)
         elif message_id == 3:  # not interested
             self.peer_interested = False
         elif message_id == 4:  # have
-            piece_index = struct.unpack('>I', payload)[0]
+            piece_index = struct.unpack_from('>I', payload)[0]
             print(f"[<] Peer has piece {piece_index}")
             if self.peer_bitfield is None:
-                self.peer_bitfield = [False] * self.piece_manager.num_pieces
-            if piece_index < len(self.peer_bitfield):
-                self.peer_bitfield[piece_index] = True
-            if not self.interested:
-                self._send_interested()
+                self.peer_bitfield = Bitfield(self.piece_manager.num_pieces)
+            if piece_index < len(self.peer_bitfield) and self.peer_bitfield.set(piece_index):
+                self.piece_picker.peer_has(piece_index)
+                if not self.piece_manager.is_piece_complete(piece_index):
+                    self._send_interested()
             if not self.choked:
                 self._request_pieces()
         elif message_id == 5:  # bitfield
-            self.peer_bitfield = self._parse_bitfield(payload)
-            self._send_interested()
+            if self.peer_bitfield is not None:
+                self.piece_picker.remove_peer(self.peer_bitfield)
+            self.peer_bitfield = Bitfield.from_bytes(payload, self.piece_manager.num_pieces)
+            self.piece_picker.add_peer(self.peer_bitfield)
+            # Only interested if the peer has a piece we lack
+            if self.peer_bitfield.difference(self.piece_manager.completed_pieces).any():
+                self._send_interested()
             if not self.choked:
                 self._request_pieces()
         elif message_id == 6:  # request
@@ -165,87 +554,157 @@ class PeerConnection:
         elif message_id == 7:  # piece
             self._handle_piece(payload)
         elif message_id == 8:  # cancel
-            pass  # Handle cancel if needed
+            if len(payload) == 12:
+                self.upload_queue.pop(struct.unpack('>III', payload), None)
+    
+    def choke(self):
+        # Queued requests are dropped by the message loop (_serve_uploads), not here
+        if not self.peer_choked:
+            self.peer_choked = True
+            self._send_control(0)
+    
+    def unchoke(self):
+        if self.peer_choked:
+            self.peer_choked = False
+            self._send_control(1)
+    
+    def send_have(self, piece_index: int):
+        try:
+            self._send(struct.pack('>IBI', 5, 4, piece_index))
+        except:
+            pass
+    
+    def _send_bitfield(self):
+        # Tell the peer which pieces we can upload; an empty bitfield may be omitted
+        completed_pieces = self.piece_manager.completed_pieces
+        if completed_pieces.any():
+            bitfield = completed_pieces.to_bytes()
+            self._send(struct.pack('>IB', 1 + len(bitfield), 5) + bitfield)
     
-    def _parse_bitfield(self, bitfield_data: bytes) -> List[bool]:
-        bitfield = []
-        for byte in bitfield_data:
-            for i in range(8):
-                bitfield.append(bool(byte & (1 << (7 - i))))
-        return bitfield
+    def _send_control(self, message_id: int):
+        try:
+            self._send(struct.pack('>IB', 1, message_id))
+        except:
+            pass
     
     def _send_interested(self):
         if not self.interested:
             self.interested = True
             message = struct.pack('>IB', 1, 2)
             try:
-                self.socket.send(message)
+                self._send(message)
                 print(f"[>] Sent interested to {self.peer_ip}:{self.peer_port}")
             except:
                 pass
     
+    def _tick(self):
+        # Runs about every TICK_INTERVAL on the connection's own thread or event loop
+        now = time.time()
+        self.next_tick = now + self.TICK_INTERVAL
+        
+        if now - self.last_received >= self.IDLE_TIMEOUT:
+            print(f"[-] {self.peer_ip}:{self.peer_port} idle for {now - self.last_received:.0f}s")
+            self.disconnect()
+            return
+        
+        if self.outbox and now - self.send_progress_at >= self.SEND_TIMEOUT:
+            print(f"[-] {self.peer_ip}:{self.peer_port} stopped reading for {now - self.send_progress_at:.0f}s")
+            self.disconnect()
+            return
+        
+        if self.choked:
+            return
+        
+        # Blocks nobody else took can come back to this peer once their hold-off is over
+        if self.expired:
+            self.expired = {key: until for key, until in self.expired.items() if until > now}
+        
+        if self.pending_requests and now - self.last_block_at >= self.SNUB_TIMEOUT:
+            # Snubbed: give everything back and keep a single probe request outstanding
+            if not self.snubbed:
+                print(f"[!] {self.peer_ip}:{self.peer_port} snubbed us, re-issuing its blocks")
+            self.snubbed = True
+            self._drop_requests(list(self.pending_requests))
+        elif self.pending_requests:
+            timeout = self.pipeline.request_timeout()
+            self._drop_requests([key for key, (_, sent_at) in list(self.pending_requests.items())
+                                 if now - sent_at >= timeout])
+        
+        # Also picks up blocks other peers dropped, even if this peer had nothing to do
+        self._request_pieces()
+    
+    def _drop_requests(self, keys: List):
+        # Hand unanswered requests back to the scheduler so other peers fetch them; this
+        # peer is not asked for them again for another request timeout
+        retry_at = time.time() + self.pipeline.request_timeout()
+        for piece_index, offset in keys:
+            request = self.pending_requests.pop((piece_index, offset), None)
+            if request is None:
+                continue
+            self.expired[(piece_index, offset)] = retry_at
+            self.scheduler.release_block(self, piece_index, offset)
+            self._send_cancel(piece_index, offset, request[0])
+    
     def _request_pieces(self):
-        if self.choked or not self.peer_bitfield:
+        if self.choked or self.peer_bitfield is None:
             return
         
-        requested_count = 0
-        max_requests = 5  # Request up to 5 pieces at once
+        depth = 1 if self.snubbed else self.pipeline.depth
+        wanted = depth - len(self.pending_requests)
+        if wanted <= 0:
+            return
         
-        # Find pieces we need that peer has
-        missing_pieces = self.piece_manager.get_missing_pieces()
+        # Let the disk writer catch up before starting more pieces, but never leave this peer idle
+        allow_new_pieces = not (self.piece_manager.is_congested() and self.pending_requests)
         
-        for piece_index in missing_pieces:
-            if requested_count >= max_requests:
+        # The scheduler hands out blocks no other peer is fetching, rarest pieces first
+        for piece_index, offset, length in self.scheduler.next_requests(
+                self, self.peer_bitfield, wanted, allow_new_pieces,
+                join_partial=not self.snubbed, exclude=self.expired):
+            if not self._request_block(piece_index, offset, length):
                 break
-                
-            if (piece_index < len(self.peer_bitfield) and 
-                self.peer_bitfield[piece_index] and 
-                not self.piece_manager.is_piece_complete(piece_index)):
-                
-                # Check if we're already requesting this piece
-                piece_already_requested = any(
-                    req_piece == piece_index for req_piece, _ in self.pending_requests.keys()
-                )
-                
-                if not piece_already_requested and len(self.pending_requests) < self.max_pending_requests:
-                    self._request_piece(piece_index)
-                    requested_count += 1
-                    print(f"[>] Requesting piece {piece_index} from {self.peer_ip}:{self.peer_port}")
     
-    def _request_piece(self, piece_index: int):
-        piece_length = self.piece_manager.get_piece_length(piece_index)
-        block_size = 16384  # 16KB blocks
+    def _request_block(self, piece_index: int, offset: int, length: int) -> bool:
+        request_msg = struct.pack('>IBIII', 13, 6, piece_index, offset, length)
+        try:
+            self._send(request_msg)
+        except:
+            self.scheduler.release_peer(self)
+            return False
         
-        for offset in range(0, piece_length, block_size):
-            length = min(block_size, piece_length - offset)
-            
-            request_msg = struct.pack('>IBIII', 13, 6, piece_index, offset, length)
-            try:
-                self.socket.send(request_msg)
-                self.pending_requests[(piece_index, offset)] = length
-            except:
-                break
+        if not self.pending_requests:
+            self.pipeline.idle()
+            self.last_block_at = time.time()
+        if offset == 0:
+            print(f"[>] Requesting piece {piece_index} from {self.peer_ip}:{self.peer_port}")
+        self.pending_requests[(piece_index, offset)] = (length, time.time())
+        return True
     
-    def _handle_piece(self, payload: bytes):
+    def _handle_piece(self, payload: memoryview):
         if len(payload) < 8:
             return
         
-        piece_index, offset = struct.unpack('>II', payload[:8])
+        # block_data is a view into the receive buffer; store_block copies it into the piece buffer
+        piece_index, offset = struct.unpack_from('>II', payload)
         block_data = payload[8:]
         
         print(f"[<] Received block: piece {piece_index}, offset {offset}, size {len(block_data)}")
         
-        # Remove from pending requests
-        if (piece_index, offset) in self.pending_requests:
-            del self.pending_requests[(piece_index, offset)]
-        
-        # Store block and check if piece is complete
-        piece_completed = self.piece_manager.store_block(piece_index, offset, block_data)
+        # Remove from pending requests and feed the timing to the pipeline
+        _, sent_at = self.pending_requests.pop((piece_index, offset), (None, None))
+        self.pipeline.block_received(len(block_data), sent_at)
+        self.last_block_at = time.time()
+        self.snubbed = False
         
-        if piece_completed:
-            if self.on_piece_received:
-                self.on_piece_received(piece_index)
-            print(f"[✓] Completed piece {piece_index}")
+        # Store block unless another peer already delivered it; a completed piece is
+        # verified and reported by the piece manager's pool. In endgame the scheduler
+        # cancels the same request on the other peers it was sent to.
+        if self.scheduler.block_received(self, piece_index, offset, len(block_data)):
+            try:
+                self.piece_manager.store_block(piece_index, offset, block_data)
+            finally:
+                self.scheduler.block_stored(piece_index)
+            self.downloaded += len(block_data)
         
         self._request_pieces()
 
@@ -253,15 +712,74 @@ class PeerConnection:
         if len(payload) != 12:
             return
         
-        piece_index, offset, length = struct.unpack('>III', payload)
-        
-        # Check if we have this piece
-        if self.piece_manager.is_piece_complete(piece_index):
-            block_data = self.piece_manager.get_block(piece_index, offset, length)
-            if block_data:
-                # Send piece
-                piece_msg = struct.pack('>IBII', 9 + len(block_data), 7, piece_index, offset) + block_data
-                try:
-                    self.socket.send(piece_msg)
-                except:
-                    pass
+        request = struct.unpack('>III', payload)
+        
+        # Queue it; the queue is served after the current batch of messages.
+        # Requests from a peer we choke are dropped.
+        if (not self.peer_choked and self.piece_manager.is_piece_complete(request[0])
+                and len(self.upload_queue) < self.MAX_QUEUED_UPLOADS):
+            self.upload_queue[request] = None
+    
+    def _serve_uploads(self):
+        if self.peer_choked:
+            # Choking discards every request the peer has queued
+            self.upload_queue.clear()
+            return
+        
+        while self.upload_queue and self.connected and not self.peer_choked and self._can_upload():
+            (piece_index, offset, length), _ = self.upload_queue.popitem(last=False)
+            try:
+                self.uploaded += self._send_piece(piece_index, offset, length)
+            except Exception as e:
+                # A piece message cut off part way leaves the stream out of sync
+                print(f"Upload error to {self.peer_ip}:{self.peer_port}: {e}")
+                self.disconnect()
+                return
+    
+    def _can_upload(self) -> bool:
+        # Past the high-water mark the rest waits until the peer has read some of it
+        return self._backlog() <= self.HIGH_WATER
+    
+    def _send_piece(self, piece_index: int, offset: int, length: int) -> int:
+        # Returns the block bytes sent, 0 for a block we can't serve
+        if not self.piece_manager.is_block_available(piece_index, offset, length):
+            return 0
+        
+        header = struct.pack('>IBII', 9 + length, 7, piece_index, offset)
+        if self.piece_manager.zero_copy:
+            self._send_piece_zero_copy(header, piece_index, offset, length)
+            return length
+        
+        block_data = self.piece_manager.get_block(piece_index, offset, length,
+                                                  requester=(self.peer_ip, self.peer_port))
+        if not block_data:
+            return 0
+        self._send(header, block_data)
+        return length
+    
+    def _send_piece_zero_copy(self, header: bytes, piece_index: int, offset: int, length: int):
+        # Queued messages and the header go out in one write, then the block straight from
+        # the file; what the socket has no room for stays queued for the message loop
+        with self.send_lock:
+            self._queue((header,))
+            self._flush_locked()
+            
+            sent = 0
+            if not self.outbox:
+                sent = self.piece_manager.send_block(self.socket.fileno(), piece_index, offset, length)
+                self.send_calls += 1
+            if sent < length:
+                self._queue((FileBlock(piece_index, offset + sent, length - sent),))
+    
+    def cancel_request(self, piece_index: int, offset: int):
+        # Another peer delivered this block first (endgame); tell this one not to send it
+        request = self.pending_requests.pop((piece_index, offset), None)
+        if request is not None:
+            self._send_cancel(piece_index, offset, request[0])
+    
+    def _send_cancel(self, piece_index: int, offset: int, length: int):
+        cancel_msg = struct.pack('>IBIII', 13, 8, piece_index, offset, length)
+        try:
+            self._send(cancel_msg)
+        except:
+            pass
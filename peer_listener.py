@@ -0,0 +1,72 @@
+import socket
+import threading
+from typing import Callable, Tuple
+from async_peer_connection import counting_protocol
+
+class PeerListener:
+    """Accepts inbound peer connections on the port announced to trackers.
+    
+    on_accept(sock, address) is called on the accept thread for each new socket
+    and must not block; the handshake is read by whoever it hands the socket to.
+    """
+    
+    ACCEPT_TIMEOUT = 1  # Seconds between checks for stop()
+    
+    def __init__(self, port: int, on_accept: Callable[[socket.socket, Tuple[str, int]], None],
+                 host: str = ''):
+        self.host = host
+        self.port = port
+        self.on_accept = on_accept
+        self.server = None
+        self.running = False
+    
+    def start(self):
+        # Raises OSError when the port is taken
+        self.server = socket.create_server((self.host, self.port), backlog=64)
+        self.server.settimeout(self.ACCEPT_TIMEOUT)
+        self.port = self.server.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True, name="peer-listener").start()
+    
+    def stop(self):
+        self.running = False
+    
+    def _accept_loop(self):
+        try:
+            while self.running:
+                try:
+                    sock, address = self.server.accept()
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    print(f"Listener error: {e}")
+                    continue
+                self.on_accept(sock, address[:2])
+        finally:
+            self.server.close()
+
+class AsyncPeerListener:
+    """PeerListener for the asyncio engine: an asyncio server on the engine's loop.
+    
+    on_accept(reader, writer) runs on the loop as the server's connection handler.
+    """
+    
+    def __init__(self, engine, port: int, on_accept: Callable, host: str = ''):
+        self.engine = engine
+        self.host = host or None
+        self.port = port
+        self.on_accept = on_accept
+        self.server = None
+    
+    def start(self):
+        # Raises OSError when the port is taken
+        # asyncio.start_server, with readers that count their receives
+        self.server = self.engine.submit(self.engine.loop.create_server(
+            lambda: counting_protocol(self.on_accept), self.host, self.port, backlog=64
+        )).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+    
+    def stop(self):
+        if self.server:
+            self.engine.call_soon(self.server.close)
+            self.server = None
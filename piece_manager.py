@@ -1,26 +1,157 @@
+import bisect
 import hashlib
+import mmap
 import os
 import threading
-from typing import Dict, List, Optional
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from bitfield import Bitfield
+from disk_io import DiskWriter, ReadCache
+from storage import STORAGE_BACKENDS
+from torrent_parser import FilePaths
+
+BLOCK_SIZE = 16384  # 16KB blocks
+RECHECK_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes of piece data hashed per recheck task
+
+def _verify_piece_range(files: List[Tuple[str, int, int]], first_piece: int,
+                        piece_hashes: Sequence[bytes], piece_length: int, total_length: int) -> List[bool]:
+    """Hash a run of consecutive pieces straight out of memory-mapped files."""
+    # files holds (path, absolute start offset, length) for every file the run overlaps.
+    # Module level so a ProcessPoolExecutor can pickle it.
+    file_starts = [file_start for _, file_start, _ in files]
+    handles = []
+    views = []
+    
+    for path, _, length in files:
+        view = None
+        if length > 0:
+            try:
+                f = open(path, 'rb')
+                handles.append(f)
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                handles.append(mapping)
+                if hasattr(mapping, 'madvise'):
+                    mapping.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mapping)
+            except (OSError, ValueError):
+                view = None  # Missing or empty file: its pieces fail
+        views.append(view)
+    
+    results = []
+    try:
+        for k, expected_hash in enumerate(piece_hashes):
+            piece_start = (first_piece + k) * piece_length
+            piece_end = min(piece_start + piece_length, total_length)
+            piece_hash = hashlib.sha1()
+            valid = True
+            
+            # Pieces can span file boundaries; feed each overlapping slice in order
+            i = max(0, bisect.bisect_right(file_starts, piece_start) - 1)
+            while i < len(files) and file_starts[i] < piece_end:
+                _, file_start, length = files[i]
+                overlap_start = max(piece_start, file_start)
+                overlap_end = min(piece_end, file_start + length)
+                if overlap_start < overlap_end:
+                    view = views[i]
+                    if view is None or len(view) < overlap_end - file_start:
+                        valid = False
+                        break
+                    piece_hash.update(view[overlap_start - file_start:overlap_end - file_start])
+                i += 1
+            
+            results.append(valid and piece_hash.digest() == expected_hash)
+    finally:
+        for view in views:
+            if view is not None:
+                view.release()
+        for handle in reversed(handles):
+            handle.close()
+    
+    return results
+
+class PieceBuffer:
+    """Assembly buffer for one in-flight piece.
+
+    Blocks are copied into a single preallocated bytearray and tracked with a
+    received-block bitmap and byte counter, so completion checks are O(1).
+    """
+    
+    def __init__(self, length: int, block_size: int = BLOCK_SIZE):
+        self.length = length
+        self.block_size = block_size
+        self.data = bytearray(length)
+        self.received = bytearray((self.num_blocks + 7) // 8)
+        self.bytes_received = 0
+    
+    @property
+    def num_blocks(self) -> int:
+        return (self.length + self.block_size - 1) // self.block_size
+    
+    def has_block(self, block_index: int) -> bool:
+        return bool(self.received[block_index >> 3] & (0x80 >> (block_index & 7)))
+    
+    def write_block(self, offset: int, data) -> bool:
+        # Only whole, aligned blocks are accepted; returns False for duplicates or bad geometry
+        if offset % self.block_size or offset >= self.length:
+            return False
+        if len(data) != min(self.block_size, self.length - offset):
+            return False
+        
+        block_index = offset // self.block_size
+        if self.has_block(block_index):
+            return False
+        
+        self.data[offset:offset + len(data)] = data
+        self.received[block_index >> 3] |= 0x80 >> (block_index & 7)
+        self.bytes_received += len(data)
+        return True
+    
+    def is_complete(self) -> bool:
+        return self.bytes_received == self.length
 
 class PieceManager:
     
-    def __init__(self, torrent_metadata: Dict, download_path: str = "./downloads"):
+    def __init__(self, torrent_metadata: Dict, download_path: str = "./downloads",
+                 on_piece_received: Callable = None, hash_workers: Optional[int] = None,
+                 max_open_files: int = 64, write_queue_size: int = 64,
+                 fsync_interval: Optional[float] = None,
+                 read_cache_size: int = 64 * 1024 * 1024, readahead_pieces: int = 2,
+                 storage: str = "file"):
         self.metadata = torrent_metadata
         self.download_path = download_path
         self.piece_length = torrent_metadata['piece_length']
         self.total_length = torrent_metadata['total_length']
         self.num_pieces = torrent_metadata['num_pieces']
-        self.pieces_hashes = self._parse_pieces_hashes(torrent_metadata['pieces'])
+        self.pieces_hashes = torrent_metadata['piece_hashes']
         
-        # Track piece completion
-        self.completed_pieces = [False] * self.num_pieces
-        self.piece_data = {}  # piece_index -> {offset -> data}
+        # Track piece completion; the counters let status queries skip scanning the bitfield
+        self.completed_pieces = Bitfield(self.num_pieces)
+        self.completed_bytes = 0
+        self.completion_lock = threading.Lock()
+        self.piece_data = {}  # piece_index -> PieceBuffer
         self.piece_locks = {i: threading.Lock() for i in range(self.num_pieces)}
         
-        # File handling
+        # Completed pieces are hashed on a worker pool, off the network threads, then handed
+        # to the disk writer. hashlib releases the GIL for large buffers, so workers hash on
+        # separate cores.
+        self.on_piece_received = on_piece_received
+        self.verifying = set()  # Pieces being hashed or waiting to be written
+        self.verify_pool = ThreadPoolExecutor(max_workers=hash_workers or os.cpu_count() or 1,
+                                              thread_name_prefix="piece-verify")
+        
+        # File handling: a storage backend ("file": pooled fds, "mmap": mapped files)
+        # fronted by the write-behind disk writer and, where it helps, a read cache
         self.files = torrent_metadata['files']
-        self.file_handles = {}
+        if storage not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage backend: {storage}")
+        paths = FilePaths(self.files, download_path)
+        self.storage = STORAGE_BACKENDS[storage](paths, self.files.lengths, max_open_files=max_open_files)
+        self.file_index = self.storage.file_index
+        self.disk_writer = DiskWriter(self.storage, max_queued=write_queue_size,
+                                      fsync_interval=fsync_interval)
+        self.read_cache = ReadCache(self._read_piece, self.num_pieces,
+                                    max_bytes=read_cache_size, readahead=readahead_pieces)
         
         # Create download directory
         os.makedirs(self.download_path, exist_ok=True)
@@ -28,15 +159,9 @@ class PieceManager:
         # Initialize files
         self._initialize_files()
     
-    def _parse_pieces_hashes(self, pieces_data: bytes) -> List[bytes]:
-        hashes = []
-        for i in range(0, len(pieces_data), 20):
-            hashes.append(pieces_data[i:i+20])
-        return hashes
-    
     def _initialize_files(self):
-        for file_info in self.files:
-            file_path = os.path.join(self.download_path, file_info['path'])
+        for file_index, file_path in enumerate(self.storage.paths):
+            length = self.files.lengths[file_index]
             
             # Create directory if needed
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
@@ -44,8 +169,9 @@ class PieceManager:
             # Create or open file
             if not os.path.exists(file_path):
                 with open(file_path, 'wb') as f:
-                    f.seek(file_info['length'] - 1)
-                    f.write(b'\0')
+                    if length > 0:
+                        f.seek(length - 1)
+                        f.write(b'\0')
     
     def get_piece_length(self, piece_index: int) -> int:
         if piece_index == self.num_pieces - 1:
@@ -56,116 +182,217 @@ class PieceManager:
     def is_piece_complete(self, piece_index: int) -> bool:
         return self.completed_pieces[piece_index]
     
-    def store_block(self, piece_index: int, offset: int, data: bytes) -> bool:
+    def store_block(self, piece_index: int, offset: int, data: memoryview) -> bool:
+        # Returns True when this block completed the piece and it was queued for verification
         with self.piece_locks[piece_index]:
-            if piece_index not in self.piece_data:
-                self.piece_data[piece_index] = {}
+            if self.completed_pieces[piece_index] or piece_index in self.verifying:
+                return False
             
-            self.piece_data[piece_index][offset] = data
+            piece_buffer = self.piece_data.get(piece_index)
+            if piece_buffer is None:
+                piece_buffer = PieceBuffer(self.get_piece_length(piece_index))
+                self.piece_data[piece_index] = piece_buffer
             
-            # Check if piece is complete
-            piece_length = self.get_piece_length(piece_index)
-            total_received = sum(len(block) for block in self.piece_data[piece_index].values())
+            # data may be a view into a peer's receive buffer; it is copied into the piece here
+            if not piece_buffer.write_block(offset, data):
+                return False
+            
+            if not piece_buffer.is_complete():
+                return False
             
-            if total_received >= piece_length:
-                return self._complete_piece(piece_index)
+            del self.piece_data[piece_index]
+            self.verifying.add(piece_index)
         
-        return False
+        self.verify_pool.submit(self._complete_piece, piece_index, piece_buffer)
+        return True
     
-    def _complete_piece(self, piece_index: int) -> bool:
-        # Reconstruct piece data
-        piece_data = b''
-        piece_length = self.get_piece_length(piece_index)
-        
-        # Sort blocks by offset
-        sorted_blocks = sorted(self.piece_data[piece_index].items())
-        current_offset = 0
-        
-        for offset, block_data in sorted_blocks:
-            if offset != current_offset:
-                # Missing data
+    def _complete_piece(self, piece_index: int, piece_buffer: PieceBuffer) -> bool:
+        # Runs on the verify pool
+        try:
+            piece_data = memoryview(piece_buffer.data)
+            
+            # Verify hash
+            piece_hash = hashlib.sha1(piece_data).digest()
+            if piece_hash != self.pieces_hashes[piece_index]:
+                print(f"Hash mismatch for piece {piece_index}")
+                self.verifying.discard(piece_index)
                 return False
-            piece_data += block_data
-            current_offset += len(block_data)
-        
-        if len(piece_data) != piece_length:
-            return False
-        
-        # Verify hash
-        piece_hash = hashlib.sha1(piece_data).digest()
-        if piece_hash != self.pieces_hashes[piece_index]:
-            print(f"Hash mismatch for piece {piece_index}")
+            
+            # Queue for the disk writer; blocks here while its queue is full
+            self.disk_writer.submit(piece_index * self.piece_length, piece_data,
+                                    lambda success: self._on_piece_written(piece_index, success))
+            return True
+        except Exception as e:
+            print(f"Error completing piece {piece_index}: {e}")
+            self.verifying.discard(piece_index)
             return False
+    
+    def _on_piece_written(self, piece_index: int, success: bool):
+        # Runs on the disk writer thread
+        if success:
+            # Mark as complete
+            self.set_piece_complete(piece_index, True)
         
-        # Write to disk
-        self._write_piece_to_disk(piece_index, piece_data)
-        
-        # Mark as complete
-        self.completed_pieces[piece_index] = True
+        # A failed piece becomes missing again and will be re-downloaded
+        self.verifying.discard(piece_index)
         
-        # Clean up memory
-        del self.piece_data[piece_index]
+        if not success:
+            return
         
         print(f"Completed piece {piece_index}/{self.num_pieces}")
-        return True
+        if self.on_piece_received:
+            self.on_piece_received(piece_index)
     
-    def _write_piece_to_disk(self, piece_index: int, piece_data: bytes):
-        piece_start = piece_index * self.piece_length
-        piece_offset = 0
-        
-        current_file_offset = 0
+    def is_congested(self) -> bool:
+        # Backpressure for piece selection while the disk writer falls behind
+        return self.disk_writer.is_congested()
+    
+    def is_block_available(self, piece_index: int, offset: int, length: int) -> bool:
+        # Whether the block lies within a piece we have, i.e. whether we can serve it
+        return (self.is_piece_complete(piece_index) and offset >= 0 and length > 0
+                and offset + length <= self.get_piece_length(piece_index))
+    
+    @property
+    def zero_copy(self) -> bool:
+        return self.storage.zero_copy
+    
+    def get_block(self, piece_index: int, offset: int, length: int,
+                  requester=None) -> Optional[memoryview]:
+        # requester identifies the peer so sequential readers get readahead
+        if not self.is_block_available(piece_index, offset, length):
+            return None
         
-        for file_info in self.files:
-            file_start = current_file_offset
-            file_end = current_file_offset + file_info['length']
-            
-            # Check if this piece overlaps with this file
-            if piece_start < file_end and piece_start + len(piece_data) > file_start:
-                # Calculate overlap
-                overlap_start = max(piece_start, file_start)
-                overlap_end = min(piece_start + len(piece_data), file_end)
-                
-                if overlap_start < overlap_end:
-                    # Calculate offsets
-                    file_offset = overlap_start - file_start
-                    piece_data_offset = overlap_start - piece_start
-                    overlap_length = overlap_end - overlap_start
-                    
-                    # Write data
-                    file_path = os.path.join(self.download_path, file_info['path'])
-                    with open(file_path, 'r+b') as f:
-                        f.seek(file_offset)
-                        f.write(piece_data[piece_data_offset:piece_data_offset + overlap_length])
-            
-            current_file_offset += file_info['length']
+        if not self.storage.cacheable:
+            return self.storage.read(piece_index * self.piece_length + offset, length)
+        return self.read_cache.get_block(piece_index, offset, length, requester)
     
-    def get_block(self, piece_index: int, offset: int, length: int) -> Optional[bytes]:
-        if not self.is_piece_complete(piece_index):
+    def is_piece_cached(self, piece_index: int) -> bool:
+        # Whether get_block can serve the piece without reading all of it from disk first
+        return not self.storage.cacheable or self.read_cache.contains(piece_index)
+    
+    def read_block(self, piece_index: int, offset: int, length: int) -> Optional[bytes]:
+        # Just this range, past the read cache, for when loading the whole piece isn't worth it
+        if not self.is_block_available(piece_index, offset, length):
             return None
+        return self.storage.read(piece_index * self.piece_length + offset, length)
+    
+    def send_block(self, out_fd: int, piece_index: int, offset: int, length: int) -> int:
+        # Zero-copy counterpart of get_block for an available block: writes what the
+        # non-blocking socket out_fd takes now and returns the byte count. The page cache
+        # takes the read cache's place here, so it is bypassed.
+        return self.storage.send_to(out_fd, piece_index * self.piece_length + offset, length)
+    
+    def _read_piece(self, piece_index: int) -> Optional[bytes]:
+        return self.storage.read(piece_index * self.piece_length, self.get_piece_length(piece_index))
+    
+    def get_piece_files(self, piece_index: int) -> List[int]:
+        # Indexes into self.files of every file this piece overlaps
+        return self.file_index.files_in_range(piece_index * self.piece_length,
+                                              self.get_piece_length(piece_index))
+    
+    def recheck(self, pieces: Optional[List[int]] = None, workers: Optional[int] = None,
+                use_processes: bool = False, progress: Callable = None) -> Dict:
+        """Verify on-disk data against pieces_hashes and update completed_pieces."""
+        # Runs of consecutive pieces are hashed in parallel from mmap'd files on a thread pool
+        # (hashlib releases the GIL) or a process pool. progress is called after each run as
+        # progress(pieces_done, pieces_total, bytes_done, elapsed).
+        if pieces is None:
+            pieces = range(self.num_pieces)
         
-        # Read from disk
-        piece_start = piece_index * self.piece_length
-        absolute_offset = piece_start + offset
+        # Split into runs of consecutive pieces of about RECHECK_CHUNK_SIZE bytes
+        pieces_per_chunk = max(1, RECHECK_CHUNK_SIZE // self.piece_length)
+        chunks = []
+        for piece_index in sorted(pieces):
+            if (chunks and piece_index == chunks[-1][0] + chunks[-1][1]
+                    and chunks[-1][1] < pieces_per_chunk):
+                chunks[-1][1] += 1
+            else:
+                chunks.append([piece_index, 1])
         
-        current_file_offset = 0
+        pieces_total = sum(count for _, count in chunks)
+        pieces_done = 0
+        pieces_valid = 0
+        bytes_done = 0
+        start_time = time.time()
         
-        for file_info in self.files:
-            file_start = current_file_offset
-            file_end = current_file_offset + file_info['length']
-            
-            if absolute_offset >= file_start and absolute_offset < file_end:
-                file_path = os.path.join(self.download_path, file_info['path'])
-                with open(file_path, 'rb') as f:
-                    f.seek(absolute_offset - file_start)
-                    return f.read(length)
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=workers or os.cpu_count() or 1) as executor:
+            futures = {}
+            for first_piece, count in chunks:
+                range_start = first_piece * self.piece_length
+                range_end = min((first_piece + count) * self.piece_length, self.total_length)
+                
+                files = [(self.storage.paths[i], self.file_index.offsets[i], self.files.lengths[i])
+                         for i in self.file_index.files_in_range(range_start, range_end - range_start)]
+                
+                future = executor.submit(_verify_piece_range, files, first_piece,
+                                         self.pieces_hashes[first_piece:first_piece + count],
+                                         self.piece_length, self.total_length)
+                futures[future] = (first_piece, range_end - range_start)
             
-            current_file_offset += file_info['length']
+            for future in as_completed(futures):
+                first_piece, chunk_bytes = futures[future]
+                results = future.result()
+                
+                for k, is_valid in enumerate(results):
+                    self.set_piece_complete(first_piece + k, is_valid)
+                
+                pieces_done += len(results)
+                pieces_valid += sum(results)
+                bytes_done += chunk_bytes
+                if progress:
+                    progress(pieces_done, pieces_total, bytes_done, time.time() - start_time)
+        
+        elapsed = time.time() - start_time
+        return {
+            "pieces_checked": pieces_done,
+            "pieces_valid": pieces_valid,
+            "bytes_checked": bytes_done,
+            "seconds": elapsed,
+            "gb_per_second": bytes_done / elapsed / 1e9 if elapsed > 0 else 0.0
+        }
+    
+    def set_piece_complete(self, piece_index: int, is_complete: bool):
+        with self.completion_lock:
+            if is_complete:
+                changed = self.completed_pieces.set(piece_index)
+            else:
+                changed = self.completed_pieces.clear(piece_index)
+            if changed:
+                delta = self.get_piece_length(piece_index)
+                self.completed_bytes += delta if is_complete else -delta
         
-        return None
+        if changed and not is_complete:
+            # A cached copy of the old data must not be served once the piece is fetched again
+            self.read_cache.invalidate(piece_index)
+    
+    def set_completed_pieces(self, bitfield: Bitfield):
+        # Replaces the whole completion state, e.g. from resume data
+        with self.completion_lock:
+            self.completed_pieces = Bitfield.from_bytes(bitfield.to_bytes(), self.num_pieces)
+            self.completed_bytes = self.completed_pieces.count * self.piece_length
+            last_piece = self.num_pieces - 1
+            if last_piece >= 0 and self.completed_pieces[last_piece]:
+                self.completed_bytes -= self.piece_length - self.get_piece_length(last_piece)
+    
+    @property
+    def completed_count(self) -> int:
+        return self.completed_pieces.count
+    
+    @property
+    def bytes_left(self) -> int:
+        return self.total_length - self.completed_bytes
     
     def get_completion_percentage(self) -> float:
-        completed = sum(self.completed_pieces)
-        return (completed / self.num_pieces) * 100 if self.num_pieces > 0 else 0
+        return (self.completed_count / self.num_pieces) * 100 if self.num_pieces > 0 else 0
     
     def get_missing_pieces(self) -> List[int]:
-        return [i for i, completed in enumerate(self.completed_pieces) if not completed]
+        # Pieces waiting on the verify pool are neither missing nor complete
+        return [i for i in range(self.num_pieces)
+                if not self.completed_pieces[i] and i not in self.verifying]
+    
+    def close(self):
+        self.verify_pool.shutdown(wait=True)
+        self.disk_writer.close()
+        self.read_cache.close()
+        self.storage.close()
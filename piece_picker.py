@@ -0,0 +1,107 @@
+import random
+import threading
+from typing import Iterable, List, Sequence
+from bitfield import Bitfield
+
+class PiecePicker:
+    """Rarest-first piece selection shared by every peer connection.
+    
+    Per-piece availability counts are updated incrementally from bitfield and
+    have messages and peer disconnects. Pieces we still need are kept in
+    buckets keyed by availability, so picking walks the rarest buckets first
+    instead of scanning every piece.
+    """
+    
+    def __init__(self, num_pieces: int, completed_pieces: Sequence[bool], random_first: int = 4):
+        self.num_pieces = num_pieces
+        self.random_first = random_first  # Until this many pieces are done, pick at random
+        self.availability = [0] * num_pieces
+        self.buckets = {}  # availability -> list of needed piece indexes
+        self.position = [-1] * num_pieces  # Index within its bucket, -1 once not needed
+        self.completed_count = 0
+        self.lock = threading.Lock()
+        
+        for piece_index in range(num_pieces):
+            if completed_pieces[piece_index]:
+                self.completed_count += 1
+            else:
+                self._bucket_add(piece_index)
+    
+    def _bucket_add(self, piece_index: int):
+        bucket = self.buckets.setdefault(self.availability[piece_index], [])
+        self.position[piece_index] = len(bucket)
+        bucket.append(piece_index)
+    
+    def _bucket_remove(self, piece_index: int):
+        # Swap-remove keeps this O(1)
+        level = self.availability[piece_index]
+        bucket = self.buckets[level]
+        position = self.position[piece_index]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self.position[last] = position
+        if not bucket:
+            del self.buckets[level]
+        self.position[piece_index] = -1
+    
+    def _adjust(self, piece_index: int, delta: int):
+        needed = self.position[piece_index] >= 0
+        if needed:
+            self._bucket_remove(piece_index)
+        self.availability[piece_index] = max(0, self.availability[piece_index] + delta)
+        if needed:
+            self._bucket_add(piece_index)
+    
+    def add_peer(self, bitfield: Bitfield):
+        with self.lock:
+            for piece_index in bitfield.indexes():
+                self._adjust(piece_index, 1)
+    
+    def remove_peer(self, bitfield: Bitfield):
+        with self.lock:
+            for piece_index in bitfield.indexes():
+                self._adjust(piece_index, -1)
+    
+    def peer_has(self, piece_index: int):
+        with self.lock:
+            self._adjust(piece_index, 1)
+    
+    def piece_completed(self, piece_index: int):
+        with self.lock:
+            if self.position[piece_index] >= 0:
+                self._bucket_remove(piece_index)
+                self.completed_count += 1
+    
+    def pick(self, peer_bitfield: Bitfield, count: int, exclude: Iterable[int] = ()) -> List[int]:
+        # Up to count needed pieces the peer has, rarest first with random tie-breaking
+        exclude = set(exclude)
+        picked = []
+        
+        def wanted(piece_index: int) -> bool:
+            return (piece_index < len(peer_bitfield) and peer_bitfield[piece_index]
+                    and piece_index not in exclude and piece_index not in picked)
+        
+        with self.lock:
+            if self.completed_count < self.random_first:
+                # Startup: random pieces finish independently, giving us something to trade sooner
+                for _ in range(count * 16):
+                    piece_index = random.randrange(self.num_pieces)
+                    if self.position[piece_index] >= 0 and wanted(piece_index):
+                        picked.append(piece_index)
+                        if len(picked) >= count:
+                            return picked
+            
+            for level in sorted(self.buckets):
+                if level == 0:
+                    continue  # Nobody has these
+                bucket = self.buckets[level]
+                start = random.randrange(len(bucket))
+                for k in range(len(bucket)):
+                    piece_index = bucket[(start + k) % len(bucket)]
+                    if wanted(piece_index):
+                        picked.append(piece_index)
+                        if len(picked) >= count:
+                            return picked
+        
+        return picked
@@ -0,0 +1,216 @@
+import threading
+from typing import Container, Dict, List, Set, Tuple
+from bitfield import Bitfield
+from piece_manager import BLOCK_SIZE
+
+# Block states within a partially downloaded piece
+OPEN = 0
+REQUESTED = 1
+RECEIVED = 2
+
+class PieceProgress:
+    """Per-block state of one partially downloaded piece."""
+    
+    def __init__(self, piece_length: int):
+        self.length = piece_length
+        self.num_blocks = (piece_length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.states = bytearray(self.num_blocks)  # OPEN / REQUESTED / RECEIVED per block
+        self.owners = {}  # block_index -> set of peers with a request out for it
+        self.received = 0
+        self.storing = 0  # Blocks accepted by block_received but not yet passed to the piece manager
+    
+    def block_length(self, block_index: int) -> int:
+        return min(BLOCK_SIZE, self.length - block_index * BLOCK_SIZE)
+
+class RequestScheduler:
+    """Swarm-wide block scheduler shared by all peer connections.
+    
+    Every block we request is claimed by the peer it was sent to, so two peers
+    never fetch the same block. Peers first fill open blocks of pieces already
+    in progress, whoever started them, before the piece picker starts new
+    pieces. Claims are released when a peer chokes us or disconnects.
+    
+    Once every remaining block is requested (endgame), blocks already claimed
+    by other peers are handed out again, up to max_duplicates owners each; the
+    first copy to arrive wins and the other owners cancel their requests.
+    """
+    
+    def __init__(self, piece_manager, piece_picker, max_duplicates: int = 3):
+        self.piece_manager = piece_manager
+        self.piece_picker = piece_picker
+        self.max_duplicates = max_duplicates
+        self.partial: Dict[int, PieceProgress] = {}
+        self.claims: Dict[object, Set[Tuple[int, int]]] = {}  # peer -> {(piece_index, block_index)}
+        self.lock = threading.Lock()
+        
+        self.endgame = False
+        self.bytes_received = 0
+        self.duplicate_bytes = 0
+        self.cancelled_requests = 0
+        self.released_blocks = 0  # Claims given back unanswered, to be re-issued to any peer
+    
+    def next_requests(self, peer, peer_bitfield: Bitfield, count: int,
+                      allow_new_pieces: bool = True, join_partial: bool = True,
+                      exclude: Container[Tuple[int, int]] = ()) -> List[Tuple[int, int, int]]:
+        # Claims up to count blocks for peer; returns (piece_index, offset, length) for each.
+        # exclude holds (piece_index, offset) of blocks whose requests to this peer expired,
+        # so they go to someone else. Snubbed peers pass join_partial=False to stay off
+        # pieces in progress altogether.
+        requests = []
+        
+        with self.lock:
+            # Finish pieces already in progress first, most complete first
+            in_progress = sorted(self.partial.items(), key=lambda item: -item[1].received) if join_partial else ()
+            for piece_index, progress in in_progress:
+                if len(requests) >= count:
+                    return requests
+                if piece_index < len(peer_bitfield) and peer_bitfield[piece_index]:
+                    self._claim_open_blocks(peer, piece_index, progress, count, requests, exclude)
+            
+            # Then start new pieces, rarest first
+            while allow_new_pieces and len(requests) < count:
+                started = False
+                for piece_index in self.piece_picker.pick(peer_bitfield, 4, exclude=self.partial.keys()):
+                    if (self.piece_manager.is_piece_complete(piece_index)
+                            or piece_index in self.piece_manager.verifying):
+                        continue
+                    progress = PieceProgress(self.piece_manager.get_piece_length(piece_index))
+                    self.partial[piece_index] = progress
+                    self._claim_open_blocks(peer, piece_index, progress, count, requests)
+                    started = True
+                    if len(requests) >= count:
+                        break
+                if not started:
+                    break
+            
+            if len(requests) < count and self._update_endgame():
+                self._claim_duplicate_blocks(peer, peer_bitfield, count, requests, exclude)
+        
+        return requests
+    
+    def _update_endgame(self) -> bool:
+        # Endgame: no piece is left to start and no block of a started piece is unrequested.
+        # It is never left again; a piece failing its hash check is simply started anew.
+        if self.endgame:
+            return True
+        
+        # A fully received piece stays in partial until it is queued for verification
+        verifying = self.piece_manager.verifying
+        needed = self.piece_picker.num_pieces - self.piece_picker.completed_count
+        unstarted = needed - len(verifying) - len([i for i in self.partial if i not in verifying])
+        if unstarted <= 0 and all(OPEN not in progress.states for progress in self.partial.values()):
+            print(f"Entering endgame: {len(self.partial)} piece(s) left in flight")
+            self.endgame = True
+        return self.endgame
+    
+    def _claim_duplicate_blocks(self, peer, peer_bitfield: Bitfield, count: int,
+                                requests: List[Tuple[int, int, int]], exclude: Container[Tuple[int, int]]):
+        # Requested blocks with the fewest owners go first; the peer must not own them already
+        candidates = []
+        for piece_index, progress in self.partial.items():
+            if piece_index >= len(peer_bitfield) or not peer_bitfield[piece_index]:
+                continue
+            for block_index, owners in progress.owners.items():
+                if (peer not in owners and len(owners) < self.max_duplicates
+                        and (piece_index, block_index * BLOCK_SIZE) not in exclude):
+                    candidates.append((len(owners), piece_index, block_index))
+        candidates.sort()
+        
+        peer_claims = self.claims.setdefault(peer, set())
+        for _, piece_index, block_index in candidates[:count - len(requests)]:
+            progress = self.partial[piece_index]
+            progress.owners[block_index].add(peer)
+            peer_claims.add((piece_index, block_index))
+            requests.append((piece_index, block_index * BLOCK_SIZE, progress.block_length(block_index)))
+    
+    def _claim_open_blocks(self, peer, piece_index: int, progress: PieceProgress,
+                           count: int, requests: List[Tuple[int, int, int]],
+                           exclude: Container[Tuple[int, int]] = ()):
+        peer_claims = self.claims.setdefault(peer, set())
+        for block_index in range(progress.num_blocks):
+            if len(requests) >= count:
+                return
+            if progress.states[block_index] != OPEN or (piece_index, block_index * BLOCK_SIZE) in exclude:
+                continue
+            progress.states[block_index] = REQUESTED
+            progress.owners[block_index] = {peer}
+            peer_claims.add((piece_index, block_index))
+            requests.append((piece_index, block_index * BLOCK_SIZE, progress.block_length(block_index)))
+    
+    def block_received(self, peer, piece_index: int, offset: int, length: int) -> bool:
+        # Returns True if the block is new and should be stored, False for duplicates.
+        # The caller stores it, then reports back with block_stored().
+        with self.lock:
+            self.bytes_received += length
+            
+            progress = self.partial.get(piece_index)
+            block_index = offset // BLOCK_SIZE
+            if (progress is None or offset % BLOCK_SIZE or block_index >= progress.num_blocks
+                    or length != progress.block_length(block_index)
+                    or progress.states[block_index] == RECEIVED):
+                self.duplicate_bytes += length
+                return False
+            
+            progress.states[block_index] = RECEIVED
+            progress.received += 1
+            progress.storing += 1
+            owners = progress.owners.pop(block_index, set())
+            for owner in owners:
+                self.claims.get(owner, set()).discard((piece_index, block_index))
+            other_owners = [owner for owner in owners if owner is not peer]
+            self.cancelled_requests += len(other_owners)
+        
+        # Endgame duplicates still in flight elsewhere; cancel outside the lock since it sends
+        for owner in other_owners:
+            owner.cancel_request(piece_index, offset)
+        
+        return True
+    
+    def block_stored(self, piece_index: int):
+        # A block accepted by block_received is in the piece manager. Once all of them are,
+        # a complete piece is queued for verification and the piece manager takes it from
+        # here; until then it stays in partial so no peer starts it again.
+        with self.lock:
+            progress = self.partial.get(piece_index)
+            if progress is None:
+                return
+            progress.storing -= 1
+            if progress.received == progress.num_blocks and not progress.storing:
+                del self.partial[piece_index]
+    
+    def release_block(self, peer, piece_index: int, offset: int):
+        # Give one of peer's claimed blocks back to the swarm
+        with self.lock:
+            self._release(peer, piece_index, offset // BLOCK_SIZE)
+    
+    def release_peer(self, peer):
+        # The peer choked us or went away: its outstanding requests will never be answered
+        with self.lock:
+            for piece_index, block_index in list(self.claims.pop(peer, ())):
+                self._release(peer, piece_index, block_index)
+    
+    def _release(self, peer, piece_index: int, block_index: int):
+        self.claims.get(peer, set()).discard((piece_index, block_index))
+        
+        progress = self.partial.get(piece_index)
+        if progress is None or progress.states[block_index] != REQUESTED:
+            return
+        
+        owners = progress.owners.get(block_index, set())
+        owners.discard(peer)
+        if not owners:
+            progress.owners.pop(block_index, None)
+            progress.states[block_index] = OPEN
+            self.released_blocks += 1
+    
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {
+                "bytes_received": self.bytes_received,
+                "duplicate_bytes": self.duplicate_bytes,
+                "duplicate_ratio": self.duplicate_bytes / self.bytes_received if self.bytes_received else 0.0,
+                "endgame": self.endgame,
+                "cancelled_requests": self.cancelled_requests,
+                "released_blocks": self.released_blocks,
+                "pieces_in_progress": len(self.partial)
+            }
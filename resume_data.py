@@ -0,0 +1,98 @@
+import json
+import os
+from typing import Dict, List, Set
+from bitfield import Bitfield
+
+class ResumeData:
+    """Fast-resume state for one torrent, stored next to the downloaded files.
+    
+    The file records which pieces were complete plus the size and mtime of every
+    data file at save time. On load, pieces are trusted as long as every file
+    they touch is unchanged; pieces touching a modified file are re-hashed
+    with PieceManager.recheck.
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, piece_manager, info_hash: bytes):
+        self.piece_manager = piece_manager
+        self.info_hash = info_hash
+        self.resume_path = os.path.join(piece_manager.download_path, f".{info_hash.hex()}.resume")
+    
+    def save(self) -> bool:
+        # Snapshot the bitfield before stat()ing the files: any piece in the snapshot
+        # was already written, so a later write can only make the recorded mtime older
+        bitfield = self.piece_manager.completed_pieces.to_bytes()
+        state = {
+            'version': self.VERSION,
+            'info_hash': self.info_hash.hex(),
+            'num_pieces': self.piece_manager.num_pieces,
+            'bitfield': bitfield.hex(),
+            'files': [self._stat_file(file_info) for file_info in self.piece_manager.files]
+        }
+        
+        temp_path = self.resume_path + ".tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.resume_path)
+            return True
+        except OSError as e:
+            print(f"Error saving resume data: {e}")
+            return False
+    
+    def load(self) -> int:
+        # Restores completed_pieces from the resume file; returns the number of complete pieces
+        state = self._read_state()
+        if state is None:
+            return 0
+        
+        completed = Bitfield.from_bytes(bytes.fromhex(state['bitfield']), self.piece_manager.num_pieces)
+        
+        modified_files = set()
+        for i, file_info in enumerate(self.piece_manager.files):
+            if self._stat_file(file_info) != state['files'][i]:
+                modified_files.add(i)
+        
+        recheck = self._pieces_in_files(modified_files)
+        
+        self.piece_manager.set_completed_pieces(completed)
+        
+        if recheck:
+            print(f"Resume: {len(modified_files)} file(s) changed, rechecking {len(recheck)} piece(s)")
+            self.piece_manager.recheck(pieces=recheck)
+        
+        return self.piece_manager.completed_count
+    
+    def _read_state(self):
+        try:
+            with open(self.resume_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable resume data: {e}")
+            return None
+        
+        if (state.get('version') != self.VERSION
+                or state.get('info_hash') != self.info_hash.hex()
+                or state.get('num_pieces') != self.piece_manager.num_pieces
+                or len(state.get('files', [])) != len(self.piece_manager.files)):
+            print("Ignoring resume data for a different torrent")
+            return None
+        
+        return state
+    
+    def _stat_file(self, file_info: Dict) -> Dict:
+        file_path = os.path.join(self.piece_manager.download_path, file_info['path'])
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return {'path': file_info['path'], 'size': None, 'mtime_ns': None}
+        return {'path': file_info['path'], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    
+    def _pieces_in_files(self, file_indexes: Set[int]) -> List[int]:
+        if not file_indexes:
+            return []
+        return [i for i in range(self.piece_manager.num_pieces)
+                if file_indexes.intersection(self.piece_manager.get_piece_files(i))]
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 """
 Simple script to run the BitTorrent client
-Usage: python run_client.py <path_to_torrent_file>
+Usage: python run_client.py [--engine thread|asyncio] [--recheck] <path_to_torrent_file>
 """
 
-import sys
+import argparse
 import os
 import time
-from bittorrent_client import BitTorrentClient
+from bittorrent_client import BitTorrentClient, PEER_ENGINES
+from storage import STORAGE_BACKENDS
 import peer_connection
 print("Using PeerConnection from:", peer_connection.__file__)
 
@@ -15,12 +16,32 @@ print("Using PeerConnection from:", peer_connection.__file__)
 def main():
     print("=== PyBitTorrent Client ===")
     
-    if len(sys.argv) != 2:
-        print("Usage: python run_client.py <torrent_file>")
-        print("Example: python run_client.py ubuntu.torrent")
-        return
+    arg_parser = argparse.ArgumentParser(
+        description="Download a torrent",
+        epilog="Example: python run_client.py ubuntu.torrent"
+    )
+    arg_parser.add_argument("torrent_file", help="path to the .torrent file")
+    arg_parser.add_argument("--engine", choices=PEER_ENGINES, default="thread",
+                            help="peer engine: one thread per peer, or a single asyncio event loop")
+    arg_parser.add_argument("--hash-workers", type=int, default=None,
+                            help="threads used to verify completed pieces (default: CPU count)")
+    arg_parser.add_argument("--storage", choices=STORAGE_BACKENDS, default="file",
+                            help="storage backend: positional file I/O or memory-mapped files")
+    arg_parser.add_argument("--min-requests", type=int, default=2,
+                            help="smallest per-peer request queue depth")
+    arg_parser.add_argument("--max-requests", type=int, default=256,
+                            help="largest per-peer request queue depth")
+    arg_parser.add_argument("--upload-slots", type=int, default=4,
+                            help="peers unchoked by transfer rate, plus one optimistic unchoke")
+    arg_parser.add_argument("--recheck", action="store_true",
+                            help="verify data already on disk before downloading")
+    arg_parser.add_argument("--recheck-workers", type=int, default=None,
+                            help="parallel hashing workers for --recheck (default: CPU count)")
+    arg_parser.add_argument("--recheck-processes", action="store_true",
+                            help="hash with a process pool instead of threads during --recheck")
+    args = arg_parser.parse_args()
     
-    torrent_file = sys.argv[1]
+    torrent_file = args.torrent_file
     
     if not os.path.exists(torrent_file):
         print(f"Error: Torrent file '{torrent_file}' not found!")
@@ -32,7 +53,9 @@ def main():
     
     # Initialize client
     print(f"Initializing BitTorrent client...")
-    client = BitTorrentClient(download_dir)
+    client = BitTorrentClient(download_dir, engine=args.engine, hash_workers=args.hash_workers,
+                              storage=args.storage, min_requests=args.min_requests,
+                              max_requests=args.max_requests, upload_slots=args.upload_slots)
     
     # Load torrent
     print(f"Loading torrent file: {torrent_file}")
@@ -40,6 +63,10 @@ def main():
         print("Failed to load torrent file!")
         return
     
+    if args.recheck:
+        print("Rechecking existing data...")
+        client.recheck(workers=args.recheck_workers, use_processes=args.recheck_processes)
+    
     # Start download
     print("Starting download...")
     client.start_download()
@@ -0,0 +1,301 @@
+import abc
+import bisect
+import errno
+import mmap
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import accumulate
+from typing import Iterator, List, Optional, Tuple
+
+class FileSpanIndex:
+    """Maps absolute torrent byte ranges onto (file, offset, length) spans with bisect."""
+    
+    def __init__(self, lengths: List[int]):
+        # Packed arrays rather than lists of ints: torrents can list 100k+ files. A FileTable's
+        # lengths are already packed and are shared rather than copied.
+        self.lengths = lengths if isinstance(lengths, array) and lengths.typecode == 'q' else array('q', lengths)
+        self.offsets = array('q', accumulate(self.lengths[:-1], initial=0)) if self.lengths else array('q')
+        self.total_length = sum(self.lengths)
+    
+    def spans(self, offset: int, length: int) -> List[Tuple[int, int, int]]:
+        # Returns (file_index, offset within file, span length) for each file the range covers
+        spans = []
+        end = min(offset + length, self.total_length)
+        file_index = max(0, bisect.bisect_right(self.offsets, offset) - 1)
+        
+        while offset < end and file_index < len(self.lengths):
+            file_start = self.offsets[file_index]
+            file_end = file_start + self.lengths[file_index]
+            if file_end > offset:
+                span_length = min(end, file_end) - offset
+                spans.append((file_index, offset - file_start, span_length))
+                offset += span_length
+            file_index += 1
+        
+        return spans
+    
+    def files_in_range(self, offset: int, length: int) -> List[int]:
+        return [file_index for file_index, _, _ in self.spans(offset, length)]
+
+class FileHandlePool:
+    """LRU pool of open file descriptors, capped at max_open.
+    
+    Descriptors in use are never evicted, so the pool can briefly exceed the cap
+    when more files than that are being accessed at once.
+    """
+    
+    def __init__(self, paths: List[str], max_open: int = 64):
+        self.paths = paths
+        self.max_open = max_open
+        self._fds = OrderedDict()  # file_index -> fd, least recently used first
+        self._in_use = {}  # file_index -> number of active users
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def acquire(self, file_index: int) -> Iterator[int]:
+        fd = self.pin(file_index)
+        try:
+            yield fd
+        finally:
+            self.unpin(file_index)
+    
+    def pin(self, file_index: int) -> int:
+        # acquire() without the context manager overhead, for per-block paths; pair with unpin()
+        with self._lock:
+            fd = self._fds.get(file_index)
+            if fd is None:
+                fd = self._open(file_index)
+                self._fds[file_index] = fd
+            else:
+                self._fds.move_to_end(file_index)
+            self._in_use[file_index] = self._in_use.get(file_index, 0) + 1
+            self._evict()
+        return fd
+    
+    def unpin(self, file_index: int):
+        with self._lock:
+            self._in_use[file_index] -= 1
+            if not self._in_use[file_index]:
+                del self._in_use[file_index]
+            self._evict()
+    
+    def _open(self, file_index: int) -> int:
+        path = self.paths[file_index]
+        try:
+            return os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        except PermissionError:
+            # Read-only data can still be seeded
+            return os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    
+    def _evict(self):
+        if len(self._fds) <= self.max_open:
+            return
+        
+        for file_index in list(self._fds):
+            if len(self._fds) <= self.max_open:
+                break
+            if file_index not in self._in_use:
+                os.close(self._fds.pop(file_index))
+    
+    def close_all(self):
+        with self._lock:
+            for file_index in list(self._fds):
+                if file_index not in self._in_use:
+                    os.close(self._fds.pop(file_index))
+
+class Storage(abc.ABC):
+    """Interface between PieceManager and the data files on disk.
+    
+    Offsets passed to read() are absolute torrent offsets; write_file() and
+    flush() work on single files, as produced by file_index.spans().
+    """
+    
+    cacheable = True  # Whether a ReadCache in front of read() pays off
+    zero_copy = False  # Whether send_to() can move data to a socket without reading it into Python
+    
+    def __init__(self, paths: List[str], lengths: List[int]):
+        self.paths = paths
+        self.file_index = FileSpanIndex(lengths)
+    
+    @abc.abstractmethod
+    def write_file(self, file_index: int, file_offset: int, buffers: List) -> int:
+        # Writes buffers back to back starting at file_offset; returns the number of write calls
+        ...
+    
+    @abc.abstractmethod
+    def read(self, offset: int, length: int):
+        ...
+    
+    def send_to(self, out_fd: int, offset: int, length: int) -> int:
+        # Writes up to length bytes at offset to the non-blocking socket out_fd; returns the
+        # number written, which is short (possibly 0) once the socket's buffer is full.
+        # PieceManager only sends this way with zero_copy set, which backends that override
+        # this do; the fallback reads the range and writes what the socket takes of it.
+        data = self.read(offset, length)
+        if data is None:
+            raise OSError(f"Range {offset}+{length} is past the end of the data")
+        try:
+            return os.write(out_fd, data)
+        except BlockingIOError:
+            return 0
+    
+    @abc.abstractmethod
+    def flush(self, file_index: int):
+        ...
+    
+    def close(self):
+        pass
+
+class FileStorage(Storage):
+    """Positional reads and writes on pooled file descriptors.
+    
+    Blocks are seeded with os.sendfile where the platform has it, so the data goes
+    from the page cache to the socket without a copy through Python.
+    """
+    
+    zero_copy = hasattr(os, 'sendfile')
+    
+    def __init__(self, paths: List[str], lengths: List[int], max_open_files: int = 64):
+        super().__init__(paths, lengths)
+        self.file_handles = FileHandlePool(paths, max_open=max_open_files)
+    
+    def write_file(self, file_index: int, file_offset: int, buffers: List) -> int:
+        buffers = list(buffers)
+        write_calls = 0
+        
+        with self.file_handles.acquire(file_index) as fd:
+            while buffers:
+                if hasattr(os, 'pwritev'):
+                    written = os.pwritev(fd, buffers, file_offset)
+                else:
+                    written = os.pwrite(fd, buffers[0], file_offset)
+                write_calls += 1
+                file_offset += written
+                
+                # Drop fully written buffers and trim a partially written one
+                while buffers and written >= len(buffers[0]):
+                    written -= len(buffers[0])
+                    buffers.pop(0)
+                if buffers and written:
+                    buffers[0] = buffers[0][written:]
+        
+        return write_calls
+    
+    def read(self, offset: int, length: int) -> Optional[bytes]:
+        # Read across file boundaries if the range spans them
+        chunks = []
+        
+        for file_index, file_offset, span_length in self.file_index.spans(offset, length):
+            with self.file_handles.acquire(file_index) as fd:
+                chunk = os.pread(fd, span_length, file_offset)
+            if len(chunk) != span_length:
+                return None
+            chunks.append(chunk)
+        
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+    
+    def send_to(self, out_fd: int, offset: int, length: int) -> int:
+        sent = 0
+        
+        for file_index, file_offset, span_length in self.file_index.spans(offset, length):
+            fd = self.file_handles.pin(file_index)
+            try:
+                while span_length:
+                    try:
+                        if self.zero_copy:
+                            count = os.sendfile(out_fd, fd, file_offset, span_length)
+                        else:
+                            count = os.write(out_fd, os.pread(fd, span_length, file_offset))
+                    except BlockingIOError:
+                        return sent
+                    except OSError as e:
+                        if not self.zero_copy or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                            raise
+                        # This file system or socket can't sendfile; stop trying and read instead
+                        self.zero_copy = False
+                        continue
+                    if count == 0:
+                        raise OSError(f"Unexpected end of file: {self.paths[file_index]}")
+                    
+                    sent += count
+                    file_offset += count
+                    span_length -= count
+            finally:
+                self.file_handles.unpin(file_index)
+        
+        return sent
+    
+    def flush(self, file_index: int):
+        with self.file_handles.acquire(file_index) as fd:
+            os.fsync(fd)
+    
+    def close(self):
+        self.file_handles.close_all()
+
+class MmapStorage(Storage):
+    """Every file memory-mapped read/write: writes are memory copies, reads are views.
+    
+    Pages already live in the OS page cache, so no ReadCache is put in front.
+    """
+    
+    cacheable = False
+    
+    def __init__(self, paths: List[str], lengths: List[int], max_open_files: int = 64):
+        # max_open_files is accepted for interface parity; mappings keep no descriptors open
+        super().__init__(paths, lengths)
+        self.maps = [None] * len(paths)
+        self.lock = threading.Lock()
+    
+    def _map(self, file_index: int) -> mmap.mmap:
+        mapping = self.maps[file_index]
+        if mapping is not None:
+            return mapping
+        
+        with self.lock:
+            if self.maps[file_index] is None:
+                length = self.file_index.lengths[file_index]
+                with open(self.paths[file_index], 'r+b') as f:
+                    # A file left shorter by another client can't be mapped past its end
+                    if os.fstat(f.fileno()).st_size < length:
+                        os.ftruncate(f.fileno(), length)
+                    self.maps[file_index] = mmap.mmap(f.fileno(), length)
+            return self.maps[file_index]
+    
+    def write_file(self, file_index: int, file_offset: int, buffers: List) -> int:
+        mapping = self._map(file_index)
+        for buffer in buffers:
+            mapping[file_offset:file_offset + len(buffer)] = buffer
+            file_offset += len(buffer)
+        return 0
+    
+    def read(self, offset: int, length: int):
+        spans = self.file_index.spans(offset, length)
+        if sum(span_length for _, _, span_length in spans) != length:
+            return None
+        
+        views = [memoryview(self._map(file_index))[file_offset:file_offset + span_length]
+                 for file_index, file_offset, span_length in spans]
+        # A single span is served as a view straight into the mapping
+        return views[0] if len(views) == 1 else b''.join(views)
+    
+    def flush(self, file_index: int):
+        self._map(file_index).flush()
+    
+    def close(self):
+        with self.lock:
+            for file_index, mapping in enumerate(self.maps):
+                if mapping is None:
+                    continue
+                try:
+                    mapping.close()
+                    self.maps[file_index] = None
+                except BufferError:
+                    pass  # A block view is still being sent; the mapping is freed with it
+
+STORAGE_BACKENDS = {
+    "file": FileStorage,
+    "mmap": MmapStorage
+}
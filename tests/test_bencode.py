@@ -0,0 +1,33 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bencode
+
+class BencodeNumberTest(unittest.TestCase):
+    """Integers and string lengths are plain ASCII digits, and integers are in canonical form."""
+    
+    def test_valid_numbers(self):
+        self.assertEqual(bencode.decode(b'i0e'), 0)
+        self.assertEqual(bencode.decode(b'i42e'), 42)
+        self.assertEqual(bencode.decode(b'i-12e'), -12)
+        self.assertEqual(bencode.decode(b'i10e'), 10)
+        self.assertEqual(bencode.decode(b'10:abcdefghij'), b'abcdefghij')
+        self.assertEqual(bencode.decode(b'0:'), b'')
+    
+    def test_malformed_integers_are_rejected(self):
+        for data in (b'i1_0e', b'i 1e', b'i1 e', b'i+1e', b'ie', b'i-e', b'i--1e', b'i\xd9\xa1e',
+                     b'i03e', b'i00e', b'i-0e', b'i-03e'):
+            with self.subTest(data=data):
+                with self.assertRaises(bencode.BencodeError):
+                    bencode.decode(data)
+    
+    def test_malformed_string_lengths_are_rejected(self):
+        for data in (b'1_0:abcdefghij', b'1 :a', b'1\t:a'):
+            with self.subTest(data=data):
+                with self.assertRaises(bencode.BencodeError):
+                    bencode.decode(data)
+
+if __name__ == "__main__":
+    unittest.main()
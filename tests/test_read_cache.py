@@ -0,0 +1,57 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from disk_io import ReadCache
+
+PIECE_LENGTH = 1024
+
+class ReadCacheTest(unittest.TestCase):
+    """A piece is read from disk once, however many requesters miss on it at the same time."""
+    
+    def setUp(self):
+        self.reads = []
+        self.held = set()  # Pieces whose reads wait for release
+        self.release = threading.Event()
+        self.cache = ReadCache(self._load_piece, num_pieces=4, readahead=1)
+    
+    def tearDown(self):
+        self.release.set()
+        self.cache.close()
+    
+    def _load_piece(self, piece_index: int) -> bytes:
+        self.reads.append(piece_index)
+        if piece_index in self.held:
+            self.release.wait(5)
+        return bytes([piece_index]) * PIECE_LENGTH
+    
+    def test_miss_waits_for_the_readahead_of_its_piece(self):
+        # Moving from piece 0 to piece 1 reads ahead piece 2, which is held up in _load_piece
+        self.held.add(2)
+        self.cache.get_block(0, 0, 16, requester="peer")
+        self.cache.get_block(1, 0, 16, requester="peer")
+        
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.cache.get_block(2, 0, 16)))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        
+        self.release.set()
+        waiter.join(5)
+        self.assertEqual(bytes(results[0]), bytes([2]) * 16)
+        self.assertEqual(self.reads.count(2), 1)
+    
+    def test_invalidated_piece_is_read_again(self):
+        self.cache.get_block(3, 0, 16)
+        self.assertTrue(self.cache.contains(3))
+        
+        self.cache.invalidate(3)
+        self.assertFalse(self.cache.contains(3))
+        self.cache.get_block(3, 0, 16)
+        self.assertEqual(self.reads.count(3), 2)
+
+if __name__ == "__main__":
+    unittest.main()
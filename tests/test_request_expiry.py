@@ -0,0 +1,113 @@
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bencode
+from bitfield import Bitfield
+from peer_connection import PeerConnection, RequestPipeline
+from piece_manager import PieceManager, BLOCK_SIZE
+from piece_picker import PiecePicker
+from request_scheduler import RequestScheduler
+from torrent_parser import TorrentParser
+
+PIECE_LENGTH = 16 * BLOCK_SIZE
+NUM_PIECES = 4
+
+class RequestExpiryTest(unittest.TestCase):
+    """Expired requests go back to the swarm rather than to the peer that let them expire."""
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        torrent_path = os.path.join(self.directory.name, "test.torrent")
+        with open(torrent_path, 'wb') as f:
+            f.write(bencode.encode({
+                b'announce': b'http://tracker.example.com:6969/announce',
+                b'info': {
+                    b'name': b'test.bin',
+                    b'piece length': PIECE_LENGTH,
+                    b'pieces': bytes(20 * NUM_PIECES),
+                    b'length': PIECE_LENGTH * NUM_PIECES
+                }
+            }))
+        
+        self.piece_manager = PieceManager(TorrentParser(torrent_path).parse(), self.directory.name)
+        self.piece_picker = PiecePicker(NUM_PIECES, self.piece_manager.completed_pieces)
+        self.scheduler = RequestScheduler(self.piece_manager, self.piece_picker)
+        self.sockets = []
+    
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.piece_manager.close()
+        self.directory.cleanup()
+    
+    def _peer(self, port: int) -> PeerConnection:
+        # An unchoked peer that has every piece, talking to a socket nobody reads
+        left, right = socket.socketpair()
+        left.settimeout(PeerConnection.TICK_INTERVAL)
+        self.sockets += [left, right]
+        
+        peer_conn = PeerConnection("127.0.0.1", port, bytes(20), bytes(20), self.piece_manager, self.scheduler)
+        peer_conn.socket = left
+        peer_conn.connected = True
+        peer_conn.choked = False
+        peer_conn.peer_bitfield = Bitfield.from_bytes(b'\xff', NUM_PIECES)
+        self.piece_picker.add_peer(peer_conn.peer_bitfield)
+        return peer_conn
+    
+    def _expire_all(self, peer_conn: PeerConnection):
+        # Sent long enough ago to be past the longest request timeout, without snubbing the peer
+        now = time.time()
+        sent_at = now - RequestPipeline.MAX_REQUEST_TIMEOUT - 1
+        for key, (length, _) in peer_conn.pending_requests.items():
+            peer_conn.pending_requests[key] = (length, sent_at)
+        peer_conn.last_received = now
+        peer_conn.last_block_at = now
+        peer_conn.next_tick = 0.0
+    
+    def test_expired_blocks_are_not_requested_again_from_the_same_peer(self):
+        slow = self._peer(1)
+        slow._request_pieces()
+        expired = set(slow.pending_requests)
+        self.assertEqual(len(expired), slow.pipeline.depth)
+        
+        self._expire_all(slow)
+        slow._tick()
+        
+        self.assertTrue(slow.pending_requests)
+        self.assertFalse(expired & set(slow.pending_requests))
+        self.assertFalse(slow.snubbed)
+    
+    def test_expired_blocks_go_to_other_peers(self):
+        slow = self._peer(1)
+        slow._request_pieces()
+        expired = set(slow.pending_requests)
+        self._expire_all(slow)
+        slow._tick()
+        
+        fast = self._peer(2)
+        fast._request_pieces()
+        self.assertTrue(expired <= set(fast.pending_requests))
+    
+    def test_expired_blocks_come_back_after_the_hold_off(self):
+        # With no other peer to take them, the blocks must not be stranded
+        slow = self._peer(1)
+        slow._request_pieces()
+        expired = set(slow.pending_requests)
+        self._expire_all(slow)
+        slow._tick()
+        self.assertFalse(expired & set(slow.pending_requests))
+        
+        slow.scheduler.release_peer(slow)
+        slow.pending_requests.clear()
+        slow.expired = dict.fromkeys(slow.expired, 0.0)
+        slow.next_tick = 0.0
+        slow._tick()
+        self.assertTrue(expired <= set(slow.pending_requests))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bencode
+from bitfield import Bitfield
+from piece_manager import PieceManager, BLOCK_SIZE
+from piece_picker import PiecePicker
+from request_scheduler import RequestScheduler
+from torrent_parser import TorrentParser
+
+PIECE_LENGTH = 2 * BLOCK_SIZE
+NUM_PIECES = 2
+
+class CompletingPieceTest(unittest.TestCase):
+    """A fully received piece is not handed out again before it is queued for verification."""
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(PIECE_LENGTH * NUM_PIECES)
+        hashes = b''.join(hashlib.sha1(self.data[i:i + PIECE_LENGTH]).digest()
+                          for i in range(0, len(self.data), PIECE_LENGTH))
+        torrent_path = os.path.join(self.directory.name, "test.torrent")
+        with open(torrent_path, 'wb') as f:
+            f.write(bencode.encode({
+                b'announce': b'http://tracker.example.com:6969/announce',
+                b'info': {
+                    b'name': b'test.bin',
+                    b'piece length': PIECE_LENGTH,
+                    b'pieces': hashes,
+                    b'length': len(self.data)
+                }
+            }))
+        
+        self.piece_manager = PieceManager(TorrentParser(torrent_path).parse(), self.directory.name)
+        self.piece_picker = PiecePicker(NUM_PIECES, self.piece_manager.completed_pieces)
+        self.scheduler = RequestScheduler(self.piece_manager, self.piece_picker)
+        self.bitfield = Bitfield.from_bytes(b'\xc0', NUM_PIECES)
+        self.piece_picker.add_peer(self.bitfield)
+        self.piece_picker.add_peer(self.bitfield)
+    
+    def tearDown(self):
+        self.piece_manager.close()
+        self.directory.cleanup()
+    
+    def _receive(self, peer, piece_index: int, offset: int) -> bool:
+        return self.scheduler.block_received(peer, piece_index, offset, BLOCK_SIZE)
+    
+    def _store(self, piece_index: int, offset: int):
+        start = piece_index * PIECE_LENGTH + offset
+        self.piece_manager.store_block(piece_index, offset, memoryview(self.data[start:start + BLOCK_SIZE]))
+        self.scheduler.block_stored(piece_index)
+    
+    def _pieces_requested(self, peer) -> set:
+        return {piece_index for piece_index, _, _ in self.scheduler.next_requests(peer, self.bitfield, 8)}
+    
+    def test_piece_is_not_started_again_before_it_is_stored(self):
+        peer_a, peer_b = object(), object()
+        self.scheduler.next_requests(peer_a, self.bitfield, 2)
+        piece_index = next(iter(self.scheduler.partial))
+        
+        self.assertTrue(self._receive(peer_a, piece_index, 0))
+        self._store(piece_index, 0)
+        self.assertTrue(self._receive(peer_a, piece_index, BLOCK_SIZE))
+        self.assertNotIn(piece_index, self._pieces_requested(peer_b))
+        
+        self._store(piece_index, BLOCK_SIZE)
+        self.assertNotIn(piece_index, self.scheduler.partial)
+        self.assertNotIn(piece_index, self._pieces_requested(peer_b))
+    
+    def test_piece_waits_for_every_accepted_block_to_be_stored(self):
+        # The last block to arrive is not necessarily the last one stored
+        peer_a, peer_b, peer_c = object(), object(), object()
+        self.scheduler.next_requests(peer_a, self.bitfield, 1)
+        self.scheduler.next_requests(peer_b, self.bitfield, 1)
+        piece_index = next(iter(self.scheduler.partial))
+        
+        self.assertTrue(self._receive(peer_a, piece_index, 0))
+        self.assertTrue(self._receive(peer_b, piece_index, BLOCK_SIZE))
+        self._store(piece_index, BLOCK_SIZE)
+        self.assertIn(piece_index, self.scheduler.partial)
+        self.assertNotIn(piece_index, self._pieces_requested(peer_c))
+        
+        self._store(piece_index, 0)
+        self.assertTrue(piece_index in self.piece_manager.verifying or self.piece_manager.is_piece_complete(piece_index))
+        self.assertNotIn(piece_index, self.scheduler.partial)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,83 +1,93 @@
 import hashlib
-import struct
-from typing import Dict, List, Any, Optional, Union
+import os
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+from typing import Dict, Any, List
+import bencode
+
+class PieceHashes(Sequence):
+    """The 20-byte SHA1 of every piece, served as memoryview slices of the pieces blob."""
+    
+    def __init__(self, pieces: bytes):
+        self.pieces = pieces
+        self.view = memoryview(pieces)
+    
+    def __len__(self) -> int:
+        return len(self.pieces) // 20
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("PieceHashes slices must be contiguous")
+            return PieceHashes(self.pieces[start * 20:max(start, stop) * 20])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece index out of range")
+        return self.view[index * 20:index * 20 + 20]
+    
+    def __reduce__(self):
+        # Slices are pickled for recheck worker processes; memoryviews cannot be
+        return PieceHashes, (self.pieces,)
+
+class FileTable(Sequence):
+    """Files of a torrent as a packed array of lengths.
+    
+    Paths are kept as one UTF-8 blob and decoded only when asked for. Items are
+    {'path', 'length'} dicts built on access.
+    """
+    
+    def __init__(self, lengths: List[int], raw_paths: List[bytes]):
+        self.lengths = array('q', lengths)
+        self.total_length = sum(self.lengths)
+        self.path_blob = b''.join(raw_paths)
+        self.path_ends = array('q', accumulate(len(raw_path) for raw_path in raw_paths))
+        self.path_blob.decode('utf-8')  # Reject undecodable paths at load time, as before
+    
+    def __len__(self) -> int:
+        return len(self.lengths)
+    
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return {'path': self.path(index), 'length': self.lengths[index]}
+    
+    def path(self, index: int) -> str:
+        start = self.path_ends[index - 1] if index > 0 else 0
+        return self.path_blob[start:self.path_ends[index]].decode('utf-8')
+
+class FilePaths(Sequence):
+    """On-disk path of each file in a FileTable, joined under root on access."""
+    
+    def __init__(self, files: FileTable, root: str):
+        self.files = files
+        self.root = root
+    
+    def __len__(self) -> int:
+        return len(self.files)
+    
+    def __getitem__(self, index: int) -> str:
+        return os.path.join(self.root, self.files.path(index))
 
 class TorrentParser:    
     def __init__(self, torrent_path: str):
         self.torrent_path = torrent_path
         self.torrent_data = None
         self.info_hash = None
-        
+    
     def parse(self) -> Dict[str, Any]:
         with open(self.torrent_path, 'rb') as f:
             torrent_bytes = f.read()
         
-        self.torrent_data = self._decode_bencode(torrent_bytes)
+        self.torrent_data, info_span = bencode.decode_with_span(torrent_bytes, b'info')
+        if info_span is None:
+            raise bencode.BencodeError("Torrent has no info dictionary")
         
-        # Calculate info hash
-        info_bytes = self._encode_bencode(self.torrent_data[b'info'])
-        self.info_hash = hashlib.sha1(info_bytes).digest()
+        # Hash the info dictionary's original bytes; re-encoding could change non-canonical input
+        self.info_hash = hashlib.sha1(memoryview(torrent_bytes)[info_span[0]:info_span[1]]).digest()
         
         return self._extract_metadata()
     
-    def _decode_bencode(self, data: bytes) -> Any:
-        def decode_next(data: bytes, index: int = 0):
-            if data[index:index+1] == b'i':
-                # Integer
-                end = data.find(b'e', index)
-                return int(data[index+1:end]), end + 1
-            elif data[index:index+1] == b'l':
-                # List
-                result = []
-                index += 1
-                while data[index:index+1] != b'e':
-                    item, index = decode_next(data, index)
-                    result.append(item)
-                return result, index + 1
-            elif data[index:index+1] == b'd':
-                # Dictionary
-                result = {}
-                index += 1
-                while data[index:index+1] != b'e':
-                    key, index = decode_next(data, index)
-                    value, index = decode_next(data, index)
-                    result[key] = value
-                return result, index + 1
-            elif data[index:index+1].isdigit():
-                # String
-                colon = data.find(b':', index)
-                length = int(data[index:colon])
-                return data[colon+1:colon+1+length], colon + 1 + length
-            else:
-                raise ValueError(f"Invalid bencode at index {index}")
-        
-        result, _ = decode_next(data)
-        return result
-    
-    def _encode_bencode(self, data: Any) -> bytes:
-        if isinstance(data, int):
-            return f"i{data}e".encode()
-        elif isinstance(data, bytes):
-            return f"{len(data)}:".encode() + data
-        elif isinstance(data, str):
-            data_bytes = data.encode('utf-8')
-            return f"{len(data_bytes)}:".encode() + data_bytes
-        elif isinstance(data, list):
-            result = b'l'
-            for item in data:
-                result += self._encode_bencode(item)
-            result += b'e'
-            return result
-        elif isinstance(data, dict):
-            result = b'd'
-            for key in sorted(data.keys()):
-                result += self._encode_bencode(key)
-                result += self._encode_bencode(data[key])
-            result += b'e'
-            return result
-        else:
-            raise ValueError(f"Cannot encode type {type(data)}")
-    
     def _extract_metadata(self) -> Dict[str, Any]:
         info = self.torrent_data[b'info']
         
@@ -88,7 +98,7 @@ class TorrentParser:
             'piece_length': info[b'piece length'],
             'pieces': info[b'pieces'],
             'name': info[b'name'].decode('utf-8'),
-            'files': [],
+            'files': None,
             'total_length': 0
         }
         
@@ -98,25 +108,21 @@ class TorrentParser:
                 tier_urls = [url.decode('utf-8') for url in tier]
                 metadata['announce_list'].append(tier_urls)
         
-        # Handle files (single or multiple)
+        # Handle files (single or multiple); only lengths and raw paths are kept, not per-file dicts
         if b'files' in info:
             # Multi-file torrent
-            for file_info in info[b'files']:
-                file_path = '/'.join([path.decode('utf-8') for path in file_info[b'path']])
-                metadata['files'].append({
-                    'path': file_path,
-                    'length': file_info[b'length']
-                })
-                metadata['total_length'] += file_info[b'length']
+            file_list = info[b'files']
+            lengths = [file_info[b'length'] for file_info in file_list]
+            raw_paths = [b'/'.join(file_info[b'path']) for file_info in file_list]
         else:
             # Single file torrent
-            metadata['files'].append({
-                'path': metadata['name'],
-                'length': info[b'length']
-            })
-            metadata['total_length'] = info[b'length']
+            lengths = [info[b'length']]
+            raw_paths = [info[b'name']]
+        metadata['files'] = FileTable(lengths, raw_paths)
+        metadata['total_length'] = metadata['files'].total_length
         
         # Calculate number of pieces
-        metadata['num_pieces'] = len(metadata['pieces']) // 20
+        metadata['piece_hashes'] = PieceHashes(metadata['pieces'])
+        metadata['num_pieces'] = len(metadata['piece_hashes'])
         
         return metadata
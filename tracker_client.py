@@ -3,18 +3,97 @@ import struct
 import urllib.parse
 import urllib.request
 import random
-from typing import List, Dict, Any, Tuple
+import threading
+from typing import List, Dict, Any, Optional, Tuple
 import time
+import bencode
+
+class TrackerError(Exception):
+    pass
+
+# Announce event names and their UDP (BEP 15) codes
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# BEP 15 actions
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_SCRAPE = 2
+UDP_ERROR = 3
+
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECTION_ID_LIFETIME = 60  # Seconds a connection ID may be used
+UDP_MAX_SCRAPE_HASHES = 74  # Info hashes that fit in one scrape packet
+UDP_MAX_PACKET = 65535
 
 class TrackerClient:
-  
-    def __init__(self, peer_id: bytes, port: int = 6881):
+    """Announces and scrapes over HTTP and UDP (BEP 15) trackers.
+    
+    UDP connection IDs are cached per tracker for their 60 s lifetime, so an
+    announce usually costs a single round trip. Unanswered UDP requests are
+    retransmitted after 15 * 2^n seconds, n = 0..udp_max_retries (BEP 15
+    allows up to 8).
+    """
+    
+    def __init__(self, peer_id: bytes, port: int = 6881, udp_base_timeout: float = 15,
+                 udp_max_retries: int = 2):
         self.peer_id = peer_id
         self.port = port
+        self.udp_base_timeout = udp_base_timeout
+        self.udp_max_retries = udp_max_retries
+        self.connection_ids = {}  # (host, port) -> (connection_id, obtained_at)
+        self.connection_ids_lock = threading.Lock()
+    
+    def announce(self, announce_url: str, info_hash: bytes,
+                 uploaded: int = 0, downloaded: int = 0, left: int = 0,
+                 event: str = 'started', timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Announce to one tracker.
+        
+        Returns {'peers', 'interval', 'min_interval'}; min_interval is None when
+        the tracker gives none. timeout bounds the whole exchange; without it HTTP
+        waits 10 s and UDP runs its full retransmit schedule. Raises TrackerError
+        on any failure.
+        """
+        if announce_url.startswith('http'):
+            return self._announce_http(announce_url, info_hash, uploaded, downloaded, left, event,
+                                       timeout or 10)
+        if announce_url.startswith('udp'):
+            return self._announce_udp(announce_url, info_hash, uploaded, downloaded, left,
+                                      UDP_EVENTS.get(event, 0), timeout)
+        raise TrackerError(f"Unsupported tracker URL: {announce_url}")
+    
+    def scrape(self, announce_url: str, info_hashes: List[bytes],
+               timeout: Optional[float] = None) -> Dict[bytes, Dict[str, int]]:
+        """Swarm counts for several torrents at once.
         
+        Returns info_hash -> {'seeders', 'completed', 'leechers'}. UDP packs up to
+        74 hashes per request; HTTP uses the tracker's /scrape URL.
+        """
+        if announce_url.startswith('udp'):
+            return self._scrape_udp(announce_url, info_hashes, timeout)
+        if announce_url.startswith('http'):
+            return self._scrape_http(announce_url, info_hashes, timeout or 10)
+        raise TrackerError(f"Unsupported tracker URL: {announce_url}")
+    
     def scrape_http_tracker(self, announce_url: str, info_hash: bytes, 
                            uploaded: int = 0, downloaded: int = 0, 
                            left: int = 0, event: str = 'started') -> List[Dict[str, Any]]:
+        try:
+            return self._announce_http(announce_url, info_hash, uploaded, downloaded, left, event)['peers']
+        except TrackerError as e:
+            print(f"HTTP tracker error: {e}")
+            return []
+    
+    def scrape_udp_tracker(self, announce_url: str, info_hash: bytes,
+                          uploaded: int = 0, downloaded: int = 0,
+                          left: int = 0, event: int = 2) -> List[Dict[str, Any]]:
+        try:
+            return self._announce_udp(announce_url, info_hash, uploaded, downloaded, left, event)['peers']
+        except TrackerError as e:
+            print(f"UDP tracker error: {e}")
+            return []
+    
+    def _announce_http(self, announce_url: str, info_hash: bytes, uploaded: int, downloaded: int,
+                       left: int, event: str, timeout: float = 10) -> Dict[str, Any]:
         params = {
             'info_hash': info_hash,
             'peer_id': self.peer_id,
@@ -26,6 +105,8 @@ class TrackerClient:
             'compact': 1,
             'numwant': 50
         }
+        if not event:
+            del params['event']
         
         # Build query string
         query_parts = []
@@ -36,89 +117,200 @@ class TrackerClient:
                 query_parts.append(f"{key}={value}")
         
         query_string = '&'.join(query_parts)
-        full_url = f"{announce_url}?{query_string}"
+        separator = '&' if '?' in announce_url else '?'
+        full_url = f"{announce_url}{separator}{query_string}"
         
         try:
-            response = urllib.request.urlopen(full_url, timeout=10)
+            response = urllib.request.urlopen(full_url, timeout=timeout)
             response_data = response.read()
             
-            # Parse bencode response
-            from torrent_parser import TorrentParser
-            parser = TorrentParser("")
-            tracker_response = parser._decode_bencode(response_data)
-            
-            if b'failure reason' in tracker_response:
-                print(f"Tracker error: {tracker_response[b'failure reason'].decode()}")
-                return []
-            
-            return self._parse_peers(tracker_response[b'peers'])
-            
+            tracker_response = bencode.decode(response_data)
         except Exception as e:
-            print(f"HTTP tracker error: {e}")
-            return []
+            raise TrackerError(str(e)) from e
+        
+        if not isinstance(tracker_response, dict):
+            raise TrackerError("Malformed tracker response")
+        if b'failure reason' in tracker_response:
+            raise TrackerError(tracker_response[b'failure reason'].decode(errors='replace'))
+        
+        return {
+            'peers': self._parse_peers(tracker_response.get(b'peers', b'')),
+            'interval': tracker_response.get(b'interval', 1800),
+            'min_interval': tracker_response.get(b'min interval')
+        }
     
-    def scrape_udp_tracker(self, announce_url: str, info_hash: bytes,
-                          uploaded: int = 0, downloaded: int = 0,
-                          left: int = 0, event: int = 2) -> List[Dict[str, Any]]:
+    def _scrape_http(self, announce_url: str, info_hashes: List[bytes],
+                     timeout: float) -> Dict[bytes, Dict[str, int]]:
+        # By convention the scrape URL replaces the last "announce" in the path
+        parsed = urllib.parse.urlparse(announce_url)
+        head, _, tail = parsed.path.rpartition('/')
+        if not tail.startswith('announce'):
+            raise TrackerError(f"Tracker does not support scrape: {announce_url}")
+        path = f"{head}/scrape{tail[len('announce'):]}"
+        query = '&'.join(([parsed.query] if parsed.query else []) +
+                         [f"info_hash={urllib.parse.quote(info_hash)}" for info_hash in info_hashes])
+        
         try:
-            # Parse UDP URL
-            parsed = urllib.parse.urlparse(announce_url)
-            host = parsed.hostname
-            port = parsed.port or 80
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(10)
-            
-            # Connect request
-            connection_id = 0x41727101980
-            action = 0  # connect
-            transaction_id = random.randint(0, 2**32 - 1)
-            
-            connect_request = struct.pack('>QII', connection_id, action, transaction_id)
-            sock.sendto(connect_request, (host, port))
-            
-            response, _ = sock.recvfrom(16)
-            resp_action, resp_transaction_id, connection_id = struct.unpack('>IIQ', response)
-            
-            if resp_action != 0 or resp_transaction_id != transaction_id:
-                return []
-            
-            # Announce request
-            action = 1  # announce
-            transaction_id = random.randint(0, 2**32 - 1)
-            key = random.randint(0, 2**32 - 1)
-            
-            announce_request = struct.pack(
+            response_data = urllib.request.urlopen(parsed._replace(path=path, query=query).geturl(),
+                                                   timeout=timeout).read()
+            scrape_response = bencode.decode(response_data)
+        except Exception as e:
+            raise TrackerError(str(e)) from e
+        
+        if not isinstance(scrape_response, dict) or not isinstance(scrape_response.get(b'files'), dict):
+            raise TrackerError("Malformed scrape response")
+        
+        return {info_hash: {
+            'seeders': stats.get(b'complete', 0),
+            'completed': stats.get(b'downloaded', 0),
+            'leechers': stats.get(b'incomplete', 0)
+        } for info_hash, stats in scrape_response[b'files'].items() if info_hash in info_hashes}
+    
+    def _announce_udp(self, announce_url: str, info_hash: bytes, uploaded: int, downloaded: int,
+                      left: int, event: int, timeout: Optional[float] = None) -> Dict[str, Any]:
+        key = random.randint(0, 2**32 - 1)
+        
+        def build(connection_id: int, transaction_id: int) -> bytes:
+            return struct.pack(
                 '>QII20s20sQQQIIIiH',
-                connection_id, action, transaction_id,
+                connection_id, UDP_ANNOUNCE, transaction_id,
                 info_hash, self.peer_id,
                 downloaded, left, uploaded,
                 event, 0, key, -1, self.port
             )
+        
+        response = self._udp_request(announce_url, UDP_ANNOUNCE, build, timeout)
+        if len(response) < 20:
+            raise TrackerError("Short announce response")
+        
+        interval, leechers, seeders = struct.unpack_from('>III', response, 8)
+        return {
+            'peers': self._parse_compact_peers(response[20:]),
+            'interval': interval,
+            'min_interval': None
+        }
+    
+    def _scrape_udp(self, announce_url: str, info_hashes: List[bytes],
+                    timeout: Optional[float] = None) -> Dict[bytes, Dict[str, int]]:
+        results = {}
+        for start in range(0, len(info_hashes), UDP_MAX_SCRAPE_HASHES):
+            batch = info_hashes[start:start + UDP_MAX_SCRAPE_HASHES]
             
-            sock.sendto(announce_request, (host, port))
-            response, _ = sock.recvfrom(1024)
-            
-            if len(response) < 20:
-                return []
+            def build(connection_id: int, transaction_id: int) -> bytes:
+                return struct.pack('>QII', connection_id, UDP_SCRAPE, transaction_id) + b''.join(batch)
             
-            resp_action, resp_transaction_id, interval, leechers, seeders = struct.unpack('>IIIII', response[:20])
+            response = self._udp_request(announce_url, UDP_SCRAPE, build, timeout)
+            if len(response) < 8 + 12 * len(batch):
+                raise TrackerError("Short scrape response")
             
-            if resp_action != 1 or resp_transaction_id != transaction_id:
-                return []
+            for i, info_hash in enumerate(batch):
+                seeders, completed, leechers = struct.unpack_from('>III', response, 8 + 12 * i)
+                results[info_hash] = {'seeders': seeders, 'completed': completed, 'leechers': leechers}
+        
+        return results
+    
+    def _udp_request(self, announce_url: str, action: int, build, timeout: Optional[float]) -> bytes:
+        # Sends build(connection_id, transaction_id) with BEP 15 retransmits and returns the
+        # matching response. A connection ID is (re)acquired whenever the cached one has expired.
+        parsed = urllib.parse.urlparse(announce_url)
+        if not parsed.hostname:
+            raise TrackerError(f"Bad tracker URL: {announce_url}")
+        deadline = time.time() + timeout if timeout is not None else None
+        
+        sock = None
+        try:
+            address = socket.getaddrinfo(parsed.hostname, parsed.port or 80,
+                                         socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             
-            # Parse peers
-            peers_data = response[20:]
-            return self._parse_compact_peers(peers_data)
+            for attempt in range(self.udp_max_retries + 1):
+                wait = self.udp_base_timeout * 2 ** attempt
+                connection_id = self._get_connection_id(sock, address, wait, deadline)
+                if connection_id is None:
+                    continue
+                
+                transaction_id = random.randint(0, 2**32 - 1)
+                sock.sendto(build(connection_id, transaction_id), address)
+                try:
+                    response = self._udp_receive(sock, transaction_id, action, wait, deadline)
+                except TrackerError:
+                    # The error may be a rejected connection ID; don't reuse it
+                    with self.connection_ids_lock:
+                        self.connection_ids.pop(address, None)
+                    raise
+                if response is not None:
+                    return response
             
-        except Exception as e:
-            print(f"UDP tracker error: {e}")
-            return []
+            raise TrackerError(f"No response after {self.udp_max_retries + 1} attempts")
+        
+        except socket.timeout:
+            raise TrackerError("Timed out")
+        except (OSError, struct.error) as e:
+            raise TrackerError(str(e)) from e
         finally:
-            if 'sock' in locals():
+            if sock:
                 sock.close()
     
-    def _parse_peers(self, peers_data: bytes) -> List[Dict[str, Any]]:
+    def _get_connection_id(self, sock: socket.socket, address: Tuple, wait: float,
+                           deadline: Optional[float]) -> Optional[int]:
+        with self.connection_ids_lock:
+            cached = self.connection_ids.get(address)
+        if cached and time.time() - cached[1] < UDP_CONNECTION_ID_LIFETIME:
+            return cached[0]
+        
+        transaction_id = random.randint(0, 2**32 - 1)
+        sock.sendto(struct.pack('>QII', UDP_PROTOCOL_ID, UDP_CONNECT, transaction_id), address)
+        sent_at = time.time()
+        response = self._udp_receive(sock, transaction_id, UDP_CONNECT, wait, deadline)
+        if response is None:
+            return None
+        if len(response) < 16:
+            raise TrackerError("Short connect response")
+        
+        connection_id = struct.unpack_from('>Q', response, 8)[0]
+        with self.connection_ids_lock:
+            self.connection_ids[address] = (connection_id, sent_at)
+        return connection_id
+    
+    def _udp_receive(self, sock: socket.socket, transaction_id: int, action: int, wait: float,
+                     deadline: Optional[float]) -> Optional[bytes]:
+        # Returns the response to transaction_id, or None once wait seconds pass without one.
+        # Late answers to earlier transmissions are skipped.
+        until = time.time() + wait
+        if deadline is not None:
+            until = min(until, deadline)
+        
+        while True:
+            remaining = until - time.time()
+            if remaining <= 0:
+                if deadline is not None and time.time() >= deadline:
+                    raise socket.timeout()
+                return None
+            
+            sock.settimeout(remaining)
+            try:
+                response, _ = sock.recvfrom(UDP_MAX_PACKET)
+            except socket.timeout:
+                continue
+            
+            if len(response) < 8:
+                continue
+            resp_action, resp_transaction_id = struct.unpack_from('>II', response)
+            if resp_transaction_id != transaction_id:
+                continue
+            
+            if resp_action == UDP_ERROR:
+                raise TrackerError(response[8:].decode(errors='replace'))
+            if resp_action != action:
+                raise TrackerError(f"Unexpected action {resp_action} in response")
+            return response
+    
+    def _parse_peers(self, peers_data) -> List[Dict[str, Any]]:
+        # Trackers that ignore compact=1 send a list of dictionaries instead
+        if isinstance(peers_data, list):
+            return [{'ip': peer[b'ip'].decode(errors='replace'), 'port': peer[b'port']}
+                    for peer in peers_data
+                    if isinstance(peer, dict) and b'ip' in peer and b'port' in peer]
         return self._parse_compact_peers(peers_data)
     
     def _parse_compact_peers(self, peers_data: bytes) -> List[Dict[str, Any]]:
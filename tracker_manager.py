@@ -0,0 +1,198 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from tracker_client import TrackerClient, TrackerError
+
+class TrackerEntry:
+    """Announce state of one tracker URL."""
+    
+    def __init__(self, url: str):
+        self.url = url
+        self.interval = None  # Seconds, from the last successful announce
+        self.min_interval = None
+        self.last_announce = 0.0  # Time of the last successful announce
+        self.retry_at = 0.0  # Not contacted again before this after a failure
+        self.failures = 0
+        self.started = False  # Whether the 'started' event was delivered
+        self.last_error = None
+
+class TrackerManager:
+    """Announces to every tracker tier concurrently and hands new peers to on_peers.
+    
+    Tiers follow BEP 12: each tier is shuffled once, its trackers are tried in
+    order until one answers, and the one that answered moves to the front of
+    its tier. Each tier then waits for that tracker's interval. A tracker that
+    fails is retried with exponential backoff. Peers already delivered within
+    PEER_DEDUP_WINDOW are not delivered again.
+    """
+    
+    DEFAULT_INTERVAL = 1800
+    MIN_BACKOFF = 15
+    MAX_BACKOFF = 1800
+    PEER_DEDUP_WINDOW = 300
+    STOP_TIMEOUT = 3
+    
+    def __init__(self, tracker_client: TrackerClient, info_hash: bytes, announce: str,
+                 announce_list: List[List[str]], get_stats: Callable[[], Tuple[int, int, int]],
+                 on_peers: Callable[[List[Dict]], None], timeout: Optional[float] = None):
+        self.tracker_client = tracker_client
+        self.info_hash = info_hash
+        self.get_stats = get_stats  # Returns (uploaded, downloaded, left)
+        self.on_peers = on_peers
+        self.timeout = timeout  # None leaves it to TrackerClient: 10 s for HTTP, retransmits for UDP
+        
+        # BEP 12: an announce-list replaces the plain announce URL
+        tier_urls = [tier for tier in announce_list if tier] or ([[announce]] if announce else [])
+        self.tiers = []
+        for urls in tier_urls:
+            tier = [TrackerEntry(url) for url in dict.fromkeys(urls)]
+            random.shuffle(tier)
+            self.tiers.append(tier)
+        
+        self.next_announce = [0.0] * len(self.tiers)  # Per tier
+        self.in_flight = set()  # Tier indexes with an announce running
+        self.delivered = {}  # (ip, port) -> time it was handed to on_peers
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.tiers)),
+                                           thread_name_prefix="tracker")
+        self.thread = None
+    
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._announce_loop, daemon=True, name="tracker-manager")
+        self.thread.start()
+    
+    def stop(self, send_stopped: bool = True):
+        self.running = False
+        self.wakeup.set()
+        
+        self.executor.shutdown(wait=False)
+        
+        if send_stopped:
+            # Best effort and in parallel, so shutdown waits on a slow tracker for STOP_TIMEOUT at most
+            entries = [tier[0] for tier in self.tiers if tier and tier[0].started]
+            if entries:
+                with ThreadPoolExecutor(max_workers=len(entries)) as executor:
+                    for entry in entries:
+                        executor.submit(self._announce_one, entry, 'stopped', self.STOP_TIMEOUT)
+    
+    def announce_now(self):
+        # Re-announce every tier as soon as its tracker's min interval allows, e.g. when out of peers
+        now = time.time()
+        with self.lock:
+            for tier_index, tier in enumerate(self.tiers):
+                earliest = tier[0].last_announce + (tier[0].min_interval or 0)
+                self.next_announce[tier_index] = min(self.next_announce[tier_index], max(now, earliest))
+        self.wakeup.set()
+    
+    def get_status(self) -> List[Dict]:
+        with self.lock:
+            return [{
+                "url": entry.url,
+                "tier": tier_index,
+                "interval": entry.interval,
+                "min_interval": entry.min_interval,
+                "failures": entry.failures,
+                "last_error": entry.last_error
+            } for tier_index, tier in enumerate(self.tiers) for entry in tier]
+    
+    def _announce_loop(self):
+        while self.running:
+            now = time.time()
+            with self.lock:
+                due = [tier_index for tier_index in range(len(self.tiers))
+                       if tier_index not in self.in_flight and self.next_announce[tier_index] <= now]
+                self.in_flight.update(due)
+                pending = [self.next_announce[i] for i in range(len(self.tiers)) if i not in self.in_flight]
+            
+            # All tiers run at once; the first answer reaches on_peers without waiting for the rest
+            for tier_index in due:
+                self.executor.submit(self._announce_tier, tier_index)
+            
+            wait = min(pending) - time.time() if pending else 60
+            self.wakeup.wait(timeout=min(max(wait, 0.1), 60))
+            self.wakeup.clear()
+    
+    def _announce_tier(self, tier_index: int):
+        tier = self.tiers[tier_index]
+        next_announce = None
+        
+        try:
+            for entry in list(tier):
+                if not self.running:
+                    return
+                if entry.retry_at > time.time():
+                    continue
+                
+                result = self._announce_one(entry, '' if entry.started else 'started')
+                if result is None:
+                    continue
+                
+                # BEP 12: the tracker that answered moves to the front of its tier
+                with self.lock:
+                    tier.remove(entry)
+                    tier.insert(0, entry)
+                next_announce = entry.last_announce + entry.interval
+                self._deliver_peers(result['peers'])
+                return
+            
+            # Every tracker in the tier failed or is backing off: retry when the first one may
+            next_announce = min(entry.retry_at for entry in tier)
+        finally:
+            with self.lock:
+                if next_announce is not None:
+                    self.next_announce[tier_index] = next_announce
+                self.in_flight.discard(tier_index)
+            self.wakeup.set()
+    
+    def _announce_one(self, entry: TrackerEntry, event: str,
+                      timeout: Optional[float] = None) -> Optional[Dict]:
+        uploaded, downloaded, left = self.get_stats()
+        try:
+            result = self.tracker_client.announce(entry.url, self.info_hash, uploaded=uploaded,
+                                                  downloaded=downloaded, left=left, event=event,
+                                                  timeout=timeout or self.timeout)
+        except TrackerError as e:
+            with self.lock:
+                entry.failures += 1
+                entry.last_error = str(e)
+                backoff = min(self.MIN_BACKOFF * 2 ** (entry.failures - 1), self.MAX_BACKOFF)
+                entry.retry_at = time.time() + backoff
+            print(f"Tracker {entry.url} failed ({e}), retrying in {backoff}s")
+            return None
+        
+        with self.lock:
+            entry.failures = 0
+            entry.last_error = None
+            entry.retry_at = 0.0
+            entry.started = entry.started or event == 'started'
+            entry.interval = result['interval'] or self.DEFAULT_INTERVAL
+            entry.min_interval = result['min_interval']
+            entry.last_announce = time.time()
+        print(f"Tracker {entry.url}: {len(result['peers'])} peers, next announce in {entry.interval}s")
+        return result
+    
+    def _deliver_peers(self, peers: List[Dict]):
+        now = time.time()
+        new_peers = []
+        with self.lock:
+            if len(self.delivered) > 10000:
+                self.delivered = {peer: at for peer, at in self.delivered.items()
+                                  if now - at < self.PEER_DEDUP_WINDOW}
+            
+            for peer in peers:
+                key = (peer['ip'], peer['port'])
+                delivered_at = self.delivered.get(key)
+                if delivered_at is not None and now - delivered_at < self.PEER_DEDUP_WINDOW:
+                    continue
+                self.delivered[key] = now
+                new_peers.append(peer)
+        
+        if new_peers:
+            self.on_peers(new_peers)